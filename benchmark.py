@@ -0,0 +1,524 @@
+"""
+Measures scrape performance against a synthetic world.
+
+Generates a world with N players (stats, advancements and gzipped NBT
+playerdata), starts a stub Mojang API and a fake RCON server, and scrapes
+MinecraftCollector with the text exposition format. The results are
+written as JSON so they can be compared across versions:
+
+    python benchmark.py --players 1000 --scrapes 20 --output before.json
+
+Exporter settings (COLLECT_WORKERS, AGGREGATE_METRICS, ...) are read from
+the environment as usual.
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid as uuid_module
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCKS = ["minecraft:%s" % block for block in (
+    "stone", "dirt", "grass_block", "cobblestone", "sand", "gravel",
+    "oak_log", "birch_log", "spruce_log", "coal_ore", "iron_ore", "gold_ore",
+    "diamond_ore", "redstone_ore", "lapis_ore", "deepslate", "netherrack",
+    "basalt", "blackstone", "end_stone", "oak_leaves", "tuff", "granite",
+    "diorite", "andesite", "clay", "snow", "ice", "obsidian", "glowstone")]
+ITEMS = BLOCKS + ["minecraft:%s" % item for item in (
+    "torch", "bread", "cooked_beef", "iron_pickaxe", "diamond_pickaxe",
+    "iron_sword", "bow", "arrow", "shield", "bucket", "water_bucket",
+    "crafting_table", "furnace", "chest", "oak_planks", "stick",
+    "iron_ingot", "gold_ingot", "diamond", "emerald", "ender_pearl",
+    "rotten_flesh", "bone", "string", "gunpowder", "flint_and_steel")]
+ENTITIES = ["minecraft:%s" % entity for entity in (
+    "zombie", "skeleton", "creeper", "spider", "enderman", "witch",
+    "slime", "cow", "pig", "sheep", "chicken", "blaze", "ghast",
+    "piglin", "drowned", "phantom", "wither_skeleton", "villager")]
+CUSTOM_STATS = ["minecraft:%s" % stat for stat in (
+    "walk_one_cm", "sprint_one_cm", "crouch_one_cm", "swim_one_cm",
+    "fall_one_cm", "climb_one_cm", "fly_one_cm", "boat_one_cm",
+    "horse_one_cm", "minecart_one_cm", "walk_on_water_one_cm",
+    "interact_with_crafting_table", "interact_with_furnace",
+    "interact_with_anvil", "interact_with_smithing_table",
+    "damage_dealt", "damage_taken", "damage_blocked_by_shield",
+    "jump", "deaths", "mob_kills", "player_kills", "play_time",
+    "total_world_time", "time_since_death", "time_since_rest",
+    "leave_game", "sleep_in_bed", "open_chest", "drop", "fish_caught",
+    "animals_bred", "traded_with_villager", "enchant_item")]
+ADVANCEMENTS = ["minecraft:%s/%s" % (category, name) for category, names in (
+    ("story", ("root", "mine_stone", "upgrade_tools", "smelt_iron",
+               "obtain_armor", "lava_bucket", "iron_tools", "deflect_arrow",
+               "form_obsidian", "mine_diamond", "enter_the_nether",
+               "shiny_gear", "enchant_item", "cure_zombie_villager",
+               "follow_ender_eye", "enter_the_end")),
+    ("nether", ("root", "return_to_sender", "find_bastion",
+                "obtain_ancient_debris", "fast_travel", "find_fortress",
+                "obtain_crying_obsidian", "distract_piglin", "ride_strider",
+                "uneasy_alliance", "loot_bastion", "use_lodestone",
+                "netherite_armor", "get_wither_skull", "obtain_blaze_rod",
+                "charge_respawn_anchor", "explore_nether", "summon_wither",
+                "brew_potion", "create_beacon", "all_potions",
+                "create_full_beacon", "all_effects")),
+    ("end", ("root", "kill_dragon", "dragon_egg", "enter_end_gateway",
+             "respawn_dragon", "dragon_breath", "find_end_city", "elytra",
+             "levitate")),
+    ("adventure", ("root", "voluntary_exile", "spyglass_at_parrot",
+                   "kill_a_mob", "trade", "honey_block_slide",
+                   "ol_betsy", "lightning_rod_with_villager_no_fire",
+                   "fall_from_world_height", "sleep_in_bed",
+                   "hero_of_the_village", "spyglass_at_ghast",
+                   "throw_trident", "shoot_arrow", "kill_all_mobs",
+                   "totem_of_undying", "summon_iron_golem",
+                   "two_birds_one_arrow", "whos_the_pillager_now",
+                   "arbalistic", "adventuring_time", "very_very_frightening",
+                   "sniper_duel", "bullseye")),
+    ("husbandry", ("root", "safely_harvest_honey", "ride_a_boat_with_a_goat",
+                   "tame_an_animal", "make_a_sign_glow", "fishy_business",
+                   "silk_touch_nest", "plant_seed", "wax_on", "bred_all_animals",
+                   "complete_catalogue", "tactical_fishing", "balanced_diet",
+                   "obtain_netherite_hoe", "wax_off", "axolotl_in_a_bucket",
+                   "kill_axolotl_target", "breed_an_animal")))
+    for name in names] + \
+    ["minecraft:recipes/misc/recipe_%d" % i for i in range(400)]
+BIOMES = ["minecraft:biome_%d" % i for i in range(60)]
+DIMENSIONS = ["minecraft:overworld", "minecraft:the_nether",
+              "minecraft:the_end"]
+DATA_VERSION = 2730
+TIMESTAMP = "2021-08-03 19:44:12 +0200"
+
+
+# NBT, only what is needed to write playerdata and chunks
+def nbt_string(value):
+    encoded = value.encode("utf-8")
+    return struct.pack(">H", len(encoded)) + encoded
+
+
+def nbt_tag(tag_type, name, payload):
+    return bytes([tag_type]) + nbt_string(name) + payload
+
+
+def nbt_list(item_type, payloads):
+    return bytes([item_type]) + struct.pack(">i", len(payloads)) + \
+        b"".join(payloads)
+
+
+def nbt_compound(tags):
+    return b"".join(tags) + b"\x00"
+
+
+def generate_player_data(rng):
+    inventory = [nbt_compound([
+        nbt_tag(1, "Slot", struct.pack(">b", slot)),
+        nbt_tag(8, "id", nbt_string(rng.choice(ITEMS))),
+        nbt_tag(1, "Count", struct.pack(">b", rng.randint(1, 64)))])
+        for slot in range(rng.randint(5, 36))]
+    recipes = [nbt_string("minecraft:recipe_%d" % i)
+               for i in range(rng.randint(50, 400))]
+    root = nbt_compound([
+        nbt_tag(3, "DataVersion", struct.pack(">i", DATA_VERSION)),
+        nbt_tag(9, "Pos", nbt_list(6, [
+            struct.pack(">d", rng.uniform(-10000, 10000))
+            for _ in range(3)])),
+        nbt_tag(9, "Rotation", nbt_list(5, [
+            struct.pack(">f", rng.uniform(-180, 180)) for _ in range(2)])),
+        nbt_tag(9, "Inventory", nbt_list(10, inventory)),
+        nbt_tag(3, "Score", struct.pack(">i", rng.randint(0, 5000))),
+        nbt_tag(3, "XpTotal", struct.pack(">i", rng.randint(0, 5000))),
+        nbt_tag(3, "XpLevel", struct.pack(">i", rng.randint(0, 50))),
+        nbt_tag(5, "Health", struct.pack(">f", rng.uniform(1, 20))),
+        nbt_tag(3, "foodLevel", struct.pack(">i", rng.randint(0, 20))),
+        nbt_tag(5, "foodSaturationLevel",
+                struct.pack(">f", rng.uniform(0, 20))),
+        nbt_tag(5, "foodExhaustionLevel",
+                struct.pack(">f", rng.uniform(0, 4))),
+        nbt_tag(3, "playerGameType", struct.pack(">i", rng.randint(0, 3))),
+        nbt_tag(8, "Dimension", nbt_string(rng.choice(DIMENSIONS))),
+        nbt_tag(10, "recipeBook", nbt_compound([
+            nbt_tag(9, "recipes", nbt_list(8, recipes)),
+            nbt_tag(9, "toBeDisplayed", nbt_list(8, recipes[:20]))])),
+    ])
+    return gzip.compress(nbt_tag(10, "", root))
+
+
+def generate_chunk(rng, entities, block_entities, legacy=False):
+    """
+    :param legacy: Nest everything in Level like before 1.18, with the
+    entities still in the chunk like before 1.17
+    :return: The uncompressed NBT of a chunk with 8 sections
+    """
+    sections = [nbt_compound([
+        nbt_tag(1, "Y", struct.pack(">b", y)),
+        nbt_tag(10, "block_states", nbt_compound([
+            nbt_tag(9, "palette", nbt_list(10, [
+                nbt_compound([nbt_tag(8, "Name", nbt_string(block))])
+                for block in rng.sample(BLOCKS, 8)])),
+            nbt_tag(12, "data", struct.pack(">i", 256) + b"".join(
+                struct.pack(">q", rng.getrandbits(63))
+                for _ in range(256)))])),
+        nbt_tag(10, "biomes", nbt_compound([
+            nbt_tag(9, "palette", nbt_list(8, [
+                nbt_string(biome) for biome in rng.sample(BIOMES, 2)]))])),
+        nbt_tag(7, "BlockLight", struct.pack(">i", 2048) + bytes(2048)),
+    ]) for y in range(-4, 4)]
+    entity_list = nbt_list(10, [nbt_compound([
+        nbt_tag(8, "id", nbt_string(rng.choice(ENTITIES))),
+        nbt_tag(9, "Pos", nbt_list(6, [
+            struct.pack(">d", rng.uniform(0, 16)) for _ in range(3)]))])
+        for _ in range(entities)])
+    block_entity_list = nbt_list(10, [nbt_compound([
+        nbt_tag(8, "id", nbt_string("minecraft:chest")),
+        nbt_tag(3, "x", struct.pack(">i", i)),
+        nbt_tag(9, "Items", nbt_list(0, []))])
+        for i in range(block_entities)])
+    if legacy:
+        root = nbt_compound([
+            nbt_tag(3, "DataVersion", struct.pack(">i", 2586)),
+            nbt_tag(10, "Level", nbt_compound([
+                nbt_tag(9, "Sections", nbt_list(10, sections)),
+                nbt_tag(9, "Entities", entity_list),
+                nbt_tag(9, "TileEntities", block_entity_list)]))])
+    else:
+        root = nbt_compound([
+            nbt_tag(3, "DataVersion", struct.pack(">i", DATA_VERSION)),
+            nbt_tag(9, "sections", nbt_list(10, sections)),
+            nbt_tag(9, "block_entities", block_entity_list),
+            nbt_tag(8, "Status", nbt_string("minecraft:full"))])
+    return nbt_tag(10, "", root)
+
+
+def compare_nbt(args):
+    """
+    Times the selective NBT decoding of the exporter against the NBT
+    library it replaced (pip install NBT, which needs Python < 3.10).
+    """
+    import io
+    import minecraft_exporter
+    from nbt.nbt import NBTFile
+
+    rng = random.Random(args.seed)
+    player_files = [generate_player_data(rng) for _ in range(args.players)]
+    chunks = [generate_chunk(rng, rng.randint(0, 20), rng.randint(0, 10))
+              for _ in range(args.players)]
+
+    def library_player(data):
+        nbt_file = NBTFile(fileobj=io.BytesIO(data))
+        return dict((tag, nbt_file[tag].value)
+                    for tag in minecraft_exporter.PLAYER_DATA_TAGS
+                    if tag in nbt_file)
+
+    def library_chunk(data):
+        nbt_file = NBTFile(buffer=io.BytesIO(data))
+        return len(nbt_file["block_entities"])
+
+    def selective_player(data):
+        return minecraft_exporter.read_nbt_tags(
+            gzip.decompress(data), minecraft_exporter.PLAYER_DATA_WANTED)
+
+    def selective_chunk(data):
+        return minecraft_exporter.count_chunk_entities(data)[1]
+
+    result = {"files": args.players}
+    for name, function, items in (
+            ("playerdata_library", library_player, player_files),
+            ("playerdata_selective", selective_player, player_files),
+            ("chunk_library", library_chunk, chunks),
+            ("chunk_selective", selective_chunk, chunks)):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        result[name + "_us"] = round(
+            (time.perf_counter() - start) / len(items) * 1e6, 1)
+    return result
+
+
+def generate_stats(rng):
+    def sample(keys, low, high):
+        return dict((key, rng.randint(1, 10 ** rng.randint(1, 6)))
+                    for key in rng.sample(keys, rng.randint(low, high)))
+
+    return {
+        "stats": {
+            "minecraft:mined": sample(BLOCKS, 5, len(BLOCKS)),
+            "minecraft:broken": sample(ITEMS, 0, 5),
+            "minecraft:crafted": sample(ITEMS, 5, 30),
+            "minecraft:used": sample(ITEMS, 10, len(ITEMS)),
+            "minecraft:picked_up": sample(ITEMS, 10, len(ITEMS)),
+            "minecraft:dropped": sample(ITEMS, 0, 20),
+            "minecraft:killed": sample(ENTITIES, 2, len(ENTITIES)),
+            "minecraft:killed_by": sample(ENTITIES, 0, 8),
+            "minecraft:custom": sample(CUSTOM_STATS, 15, len(CUSTOM_STATS)),
+        },
+        "DataVersion": DATA_VERSION,
+    }
+
+
+def generate_advancements(rng):
+    advancements = dict()
+    for key in rng.sample(ADVANCEMENTS, rng.randint(20, len(ADVANCEMENTS))):
+        if key.endswith("adventuring_time"):
+            criteria = rng.sample(BIOMES, rng.randint(1, len(BIOMES)))
+        else:
+            criteria = ["criterion_%d" % i for i in range(rng.randint(1, 3))]
+        advancements[key] = {
+            "criteria": dict((criterion, TIMESTAMP)
+                             for criterion in criteria),
+            "done": rng.random() < 0.8,
+        }
+    advancements["DataVersion"] = DATA_VERSION
+    return advancements
+
+
+def write_json(path, data):
+    with open(path, "w") as json_file:
+        json.dump(data, json_file, indent=2)
+
+
+def generate_world(directory, players, seed, usercache_share):
+    """
+    Writes a world with the given number of players to directory/world.
+    :return: The list of (uuid, name) of the players
+    """
+    rng = random.Random(seed)
+    world = os.path.join(directory, "world")
+    for subdirectory in ("stats", "advancements", "playerdata"):
+        os.makedirs(os.path.join(world, subdirectory))
+
+    result = []
+    for i in range(players):
+        uuid = str(uuid_module.UUID(int=rng.getrandbits(128), version=4))
+        result.append((uuid, "player%d" % i))
+        write_json(os.path.join(world, "stats", uuid + ".json"),
+                   generate_stats(rng))
+        write_json(os.path.join(world, "advancements", uuid + ".json"),
+                   generate_advancements(rng))
+        with open(os.path.join(world, "playerdata", uuid + ".dat"),
+                  "wb") as dat_file:
+            dat_file.write(generate_player_data(rng))
+
+    write_json(os.path.join(directory, "usercache.json"), [
+        {"uuid": uuid, "name": name, "expiresOn": "2099-01-01 00:00:00 +0000"}
+        for uuid, name in result[:int(players * usercache_share)]])
+    return result
+
+
+def touch_players(directory, players, share, rng):
+    """
+    Rewrites the stats of a share of the players, like the server does
+    when it saves.
+    """
+    for uuid, _ in rng.sample(players, int(len(players) * share)):
+        write_json(os.path.join(directory, "world", "stats", uuid + ".json"),
+                   generate_stats(rng))
+
+
+class MojangStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        uuid = self.path.rstrip("/").rsplit("/", 1)[-1]
+        body = json.dumps(
+            {"id": uuid.replace("-", ""), "name": "mojang_" + uuid[:8]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_mojang_stub():
+    """
+    :return: The profile URL of a stub Mojang API
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MojangStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:%i/profile/%%s" % server.server_address[1]
+
+
+def serve_rcon(connection, password, responses):
+    def read_exactly(length):
+        data = b""
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def send(request_id, packet_type, body):
+        packet = struct.pack("<ii", request_id, packet_type) + \
+            body.encode() + b"\x00\x00"
+        connection.sendall(struct.pack("<i", len(packet)) + packet)
+
+    try:
+        while True:
+            length = struct.unpack("<i", read_exactly(4))[0]
+            packet = read_exactly(length)
+            request_id, packet_type = struct.unpack("<ii", packet[:8])
+            body = packet[8:-2].decode()
+            if packet_type == 3:
+                send(request_id if body == password else -1, 2, "")
+            elif packet_type == 2:
+                # Like the server, split long responses into 4096 byte
+                # packets
+                response = responses.get(body, "Unknown command")
+                for start in range(0, max(len(response), 1), 4096):
+                    send(request_id, 0, response[start:start + 4096])
+            else:
+                # the client's end of response marker
+                send(request_id, 0, "Unknown request %x" % packet_type)
+    except (EOFError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def start_fake_rcon(password, players, responses=None):
+    """
+    Starts an RCON server that answers the list command.
+    :param responses: command -> response of further commands
+    :return: Its port
+    """
+    online = [name for _, name in players[:20]]
+    responses = dict(responses or {}, **{
+        "list": "There are %i of a max of 100 players online: %s"
+                % (len(online), ", ".join(online)),
+    })
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def accept():
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=serve_rcon,
+                             args=(connection, password, responses),
+                             daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix="minecraft-exporter-benchmark-")
+    try:
+        start = time.time()
+        players = generate_world(
+            directory, args.players, args.seed, args.usercache)
+        generate_duration = time.time() - start
+
+        os.environ["WORLD_DIR"] = os.path.join(directory, "world")
+        os.environ["USERCACHE_FILE"] = os.path.join(
+            directory, "usercache.json")
+        os.environ["MOJANG_API_URL"] = start_mojang_stub()
+        os.environ.setdefault("MOJANG_API_RATE_LIMIT", "1000")
+        os.environ["RCON_HOST"] = "127.0.0.1"
+        os.environ["RCON_PORT"] = str(start_fake_rcon("benchmark", players))
+        os.environ["RCON_PASSWORD"] = "benchmark"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+        # the exporter reads some settings when it is imported
+        from prometheus_client import CollectorRegistry, generate_latest
+        import minecraft_exporter
+
+        collector = minecraft_exporter.MinecraftCollector.from_env()
+        registry = CollectorRegistry()
+        registry.register(collector)
+        # let RCON connect and the first poll finish
+        time.sleep(args.warmup)
+
+        rng = random.Random(args.seed)
+        durations = []
+        output = b""
+        for i in range(args.scrapes + 1):
+            if i > 1 and args.changed > 0:
+                touch_players(directory, players, args.changed, rng)
+            start = time.perf_counter()
+            output = generate_latest(registry)
+            durations.append(time.perf_counter() - start)
+
+        lines = output.decode("utf-8").splitlines()
+        warm = durations[1:]
+        return {
+            "players": args.players,
+            "scrapes": args.scrapes,
+            "changed_share": args.changed,
+            "generate_seconds": round(generate_duration, 3),
+            "cold_scrape_seconds": round(durations[0], 6),
+            "p50_scrape_seconds": round(percentile(warm, 0.5), 6),
+            "p99_scrape_seconds": round(percentile(warm, 0.99), 6),
+            "mean_scrape_seconds": round(sum(warm) / len(warm), 6),
+            # kilobytes on Linux
+            "peak_rss_kib": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            "series": sum(1 for line in lines
+                          if line and not line.startswith("#")),
+            "payload_bytes": len(output),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+        else:
+            print("World kept in %s" % directory, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark scrapes against a synthetic world.")
+    parser.add_argument("--players", type=int, default=100,
+                        help="number of players to generate")
+    parser.add_argument("--scrapes", type=int, default=20,
+                        help="number of scrapes after the first one")
+    parser.add_argument("--changed", type=float, default=0.05,
+                        help="share of players saved between scrapes")
+    parser.add_argument("--usercache", type=float, default=0.5,
+                        help="share of players in usercache.json")
+    parser.add_argument("--warmup", type=float, default=2.0,
+                        help="seconds to wait for RCON before scraping")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output",
+                        help="file to write the JSON results to")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated world")
+    parser.add_argument("--compare-nbt", action="store_true",
+                        help="time the NBT decoding of --players playerdata"
+                             " files and chunks against the NBT library"
+                             " instead")
+    args = parser.parse_args()
+
+    result = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "environment": dict(
+            (key, value) for key, value in os.environ.items()
+            if key in ("COLLECT_WORKERS", "COLLECT_POOL", "WATCH_FILES",
+                       "ACTIVE_PLAYER_DAYS", "INACTIVE_PLAYERS",
+                       "AGGREGATE_METRICS", "JSON_DECODER", "FILTER_CONFIG",
+                       "ADVANCEMENT_COMPLETION_RATIO")),
+        "result": compare_nbt(args) if args.compare_nbt else run(args),
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
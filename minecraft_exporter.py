@@ -1,19 +1,44 @@
+import asyncio
+import cProfile
+import contextlib
+import gzip
+import heapq
 import json
+import ctypes
+import fnmatch
 import logging
-import nbt
+import marshal
+import mmap
+import multiprocessing
 import os
+import queue
 import re
 import requests
-import schedule
+import socket
+import struct
+import threading
 import time
-from mcrcon import MCRcon
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer
 from os import listdir
 from os.path import isfile, isdir, join
+from urllib.parse import parse_qs, urlparse
 # noinspection PyProtectedMember
-from prometheus_client import start_http_server
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Histogram
+from prometheus_client.exposition import MetricsHandler
+from prometheus_client.openmetrics.exposition import \
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE, \
+    generate_latest as generate_openmetrics
 from prometheus_client.core import REGISTRY, \
-    GaugeMetricFamily, CounterMetricFamily
-from retry import retry
+    GaugeMetricFamily, CounterMetricFamily, Metric
+from prometheus_client.samples import Sample
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Can move this around or add handlers as needed
 m_logger = logging.getLogger(__name__)
@@ -29,7 +54,8 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 m_logger.addHandler(ch)
 
-MOJANG_API_NAMES_URL = "https://api.mojang.com/user/profiles/%s/names"
+MOJANG_API_PROFILE_URL = \
+    "https://sessionserver.mojang.com/session/minecraft/profile/%s"
 MC_DIMENSION_OVERWORLD = "minecraft:overworld"
 MC_DIMENSION_NETHER = "minecraft:the_nether"
 MC_DIMENSION_THE_END = "minecraft:the_end"
@@ -48,493 +74,3612 @@ def get_dimension_value(dimension):
     return result
 
 
-class MinecraftCollector(object):
+# Every metric a player file can produce, in the order they are exported.
+# Readers return samples as (metric name, label values, value) tuples which
+# are cheap to cache and to pass between processes, the families are only
+# built once per scrape in build_metric_families.
+PLAYER_METRICS = {
+    # advancements
+    'minecraft_advancement_data_version': (
+        CounterMetricFamily,
+        "The data version of the advancements file",
+        ['player']),
+    # aka minecraft
+    'minecraft_advancement_story_count': (
+        CounterMetricFamily,
+        "The count of completed story advancements.",
+        ['player']),
+    'minecraft_advancement_nether_count': (
+        CounterMetricFamily,
+        "The count of completed nether advancements.",
+        ['player']),
+    'minecraft_advancement_end_count': (
+        CounterMetricFamily,
+        "The count of completed end advancements.",
+        ['player']),
+    'minecraft_advancement_adventure_count': (
+        CounterMetricFamily,
+        "The count of completed adventure advancements.",
+        ['player']),
+    'minecraft_advancement_husbandry_count': (
+        CounterMetricFamily,
+        "The count of completed husbandry advancements.",
+        ['player']),
+    'minecraft_advancement_recipe_count': (
+        CounterMetricFamily,
+        "The count of completed recipe advancements.",
+        ['player']),
+    'minecraft_advancement_other_count': (
+        CounterMetricFamily,
+        "The count of completed other advancements.",
+        ['player']),
+    'minecraft_advancements_completed': (
+        CounterMetricFamily,
+        "The count of completed advancements by namespace and category.",
+        ['player', 'namespace', 'category']),
+
+    # playerdata
+    #  TODO double check that score resets on death in server
+    'minecraft_score': (
+        GaugeMetricFamily,
+        "The score of a player.",
+        ['player']),
+    # This is still a gauge because it can reset on death vs server
+    'minecraft_xp_total': (
+        GaugeMetricFamily,
+        "The total amount of XP the player has collected over time;"
+        " used for the Score upon death.",
+        ['player']),
+    'minecraft_current_level': (
+        GaugeMetricFamily,
+        "The level shown on the XP bar.",
+        ['player']),
+    'minecraft_health': (
+        GaugeMetricFamily,
+        "How much Health the player currently has",
+        ['player']),
+    'minecraft_food_level': (
+        GaugeMetricFamily,
+        "The value of the hunger bar; 20 is full.",
+        ['player']),
+    'minecraft_food_saturation_level': (
+        GaugeMetricFamily,
+        "The food saturation the player currently has.",
+        ['player']),
+    'minecraft_food_exhaustion_level': (
+        GaugeMetricFamily,
+        "The food exhaustion the player currently has.",
+        ['player']),
+    'minecraft_game_type': (
+        GaugeMetricFamily,
+        "The game mode of the player."
+        " 0 is Survival, 1 is Creative,"
+        " 2 is Adventure and 3 is Spectator.",
+        ['player']),
+    'minecraft_dimension': (
+        GaugeMetricFamily,
+        "A namespaced ID of the dimension the player is in.",
+        ['player', 'dimension']),
+
+    # stats
+    # Define a metric for each category of stat
+    # https://minecraft.fandom.com/wiki/Statistics#Statistic_types_and_names
+    'minecraft_blocks_mined_total': (
+        CounterMetricFamily,
+        'The count of blocks a player mined by block type.',
+        ['player', 'block']),
+    'minecraft_items_broken_total': (
+        CounterMetricFamily,
+        'The count of items a player has used to negative durability.',
+        ['player', 'item']),
+    'minecraft_items_crafted_total': (
+        CounterMetricFamily,
+        'The count of items a player has crafted, smelted, etc.',
+        ['player', 'item']),
+    'minecraft_items_used_total': (
+        CounterMetricFamily,
+        'The count of blocks or items a player used.',
+        ['player', 'item']),
+    'minecraft_items_picked_up_total': (
+        CounterMetricFamily,
+        'The count of items a player picked up.',
+        ['player', 'item']),
+    'minecraft_items_dropped_total': (
+        CounterMetricFamily,
+        'The count of items a player has dropped.',
+        ['player', 'item']),
+    'minecraft_entities_killed_total': (
+        CounterMetricFamily,
+        "The count of entities killed by a player.",
+        ['player', 'entity']),
+    'minecraft_entities_killed_by_total': (
+        CounterMetricFamily,
+        "The count of entities that killed a player",
+        ['player', 'entity']),
+    # Let's break out some sub-categories from the
+    # custom stats to avoid high label cardinality (where we can)
+    'minecraft_distance_traveled_cm_total': (
+        CounterMetricFamily,
+        "The total distance traveled by method of transportation.",
+        ['player', 'method']),
+    'minecraft_interactions_total': (
+        CounterMetricFamily,
+        "The number of times interacted with various workstations.",
+        ['player', 'workstation']),
+    'minecraft_damage_total': (
+        CounterMetricFamily,
+        "The amount of damage a player has dealt/taken by category.",
+        ['player', 'category']),
+    'minecraft_custom': (
+        CounterMetricFamily,
+        "Custom Minecraft stat",
+        ['player', 'custom_stat']),
+}
+
+# Stat categories that map 1:1 onto a metric
+STATS_CATEGORY_METRICS = {
+    "minecraft:mined": 'minecraft_blocks_mined_total',
+    "minecraft:broken": 'minecraft_items_broken_total',
+    "minecraft:crafted": 'minecraft_items_crafted_total',
+    "minecraft:used": 'minecraft_items_used_total',
+    "minecraft:picked_up": 'minecraft_items_picked_up_total',
+    "minecraft:items_dropped": 'minecraft_items_dropped_total',
+    "minecraft:killed": 'minecraft_entities_killed_total',
+    "minecraft:killed_by": 'minecraft_entities_killed_by_total',
+}
+
+
+# Selective NBT decoding, see read_nbt_tags
+NBT_LENGTH = "length"
+NBT_FIXED_FORMATS = {
+    1: struct.Struct(">b"),
+    2: struct.Struct(">h"),
+    3: struct.Struct(">i"),
+    4: struct.Struct(">q"),
+    5: struct.Struct(">f"),
+    6: struct.Struct(">d"),
+}
+NBT_ARRAY_ITEM_SIZES = {7: 1, 11: 4, 12: 8}
+NBT_ARRAY_ITEM_FORMATS = {7: "b", 11: "i", 12: "q"}
+NBT_INT = struct.Struct(">i")
+NBT_USHORT = struct.Struct(">H")
+
+
+def skip_nbt_payload(data, tag_type, pos):
+    """
+    :return: The position after the payload of a tag, without decoding it
+    """
+    fixed = NBT_FIXED_FORMATS.get(tag_type)
+    if fixed is not None:
+        return pos + fixed.size
+    elif tag_type == 8:
+        return pos + 2 + NBT_USHORT.unpack_from(data, pos)[0]
+    elif tag_type in NBT_ARRAY_ITEM_SIZES:
+        length = NBT_INT.unpack_from(data, pos)[0]
+        return pos + 4 + length * NBT_ARRAY_ITEM_SIZES[tag_type]
+    elif tag_type == 9:
+        item_type = data[pos]
+        length = NBT_INT.unpack_from(data, pos + 1)[0]
+        pos += 5
+        fixed = NBT_FIXED_FORMATS.get(item_type)
+        if fixed is not None:
+            return pos + length * fixed.size
+        for _ in range(length):
+            pos = skip_nbt_payload(data, item_type, pos)
+        return pos
+    elif tag_type == 10:
+        while True:
+            item_type = data[pos]
+            if item_type == 0:
+                return pos + 1
+            pos += 3 + NBT_USHORT.unpack_from(data, pos + 1)[0]
+            pos = skip_nbt_payload(data, item_type, pos)
+    raise ValueError("Unknown NBT tag type %i." % tag_type)
+
+
+def decode_nbt_payload(data, tag_type, pos):
+    """
+    :return: (value, position after the payload)
+    """
+    fixed = NBT_FIXED_FORMATS.get(tag_type)
+    if fixed is not None:
+        return fixed.unpack_from(data, pos)[0], pos + fixed.size
+    elif tag_type == 8:
+        length = NBT_USHORT.unpack_from(data, pos)[0]
+        end = pos + 2 + length
+        return bytes(data[pos + 2:end]).decode("utf8", "replace"), end
+    elif tag_type in NBT_ARRAY_ITEM_SIZES:
+        length = NBT_INT.unpack_from(data, pos)[0]
+        item_format = NBT_ARRAY_ITEM_FORMATS[tag_type]
+        value = list(struct.unpack_from(
+            ">%i%s" % (length, item_format), data, pos + 4))
+        return value, pos + 4 + length * NBT_ARRAY_ITEM_SIZES[tag_type]
+    elif tag_type == 9:
+        item_type = data[pos]
+        length = NBT_INT.unpack_from(data, pos + 1)[0]
+        pos += 5
+        value = []
+        for _ in range(length):
+            item, pos = decode_nbt_payload(data, item_type, pos)
+            value.append(item)
+        return value, pos
+    elif tag_type == 10:
+        value = dict()
+        while True:
+            item_type = data[pos]
+            if item_type == 0:
+                return value, pos + 1
+            name_length = NBT_USHORT.unpack_from(data, pos + 1)[0]
+            name = bytes(data[pos + 3:pos + 3 + name_length]).decode(
+                "utf8", "replace")
+            value[name], pos = decode_nbt_payload(
+                data, item_type, pos + 3 + name_length)
+    raise ValueError("Unknown NBT tag type %i." % tag_type)
+
+
+def nbt_payload_length(data, tag_type, pos):
+    if tag_type in NBT_ARRAY_ITEM_SIZES:
+        return NBT_INT.unpack_from(data, pos)[0]
+    elif tag_type == 9:
+        return NBT_INT.unpack_from(data, pos + 1)[0]
+    elif tag_type == 8:
+        return NBT_USHORT.unpack_from(data, pos)[0]
+    elif tag_type == 10:
+        return len(decode_nbt_payload(data, tag_type, pos)[0])
+    return None
+
+
+def select_nbt_tags(data, pos, wanted, stop_when_found=False):
+    """
+    Walks the payload of a compound tag and decodes only the wanted tags.
+    :return: (found tags, position after the compound or None if the walk
+    stopped early)
+    """
+    result = dict()
+    while True:
+        tag_type = data[pos]
+        if tag_type == 0:
+            return result, pos + 1
+        name_length = NBT_USHORT.unpack_from(data, pos + 1)[0]
+        name_end = pos + 3 + name_length
+        name = bytes(data[pos + 3:name_end]).decode("utf8", "replace")
+        pos = name_end
+
+        spec = wanted.get(name)
+        if spec is None:
+            pos = skip_nbt_payload(data, tag_type, pos)
+            continue
+
+        if isinstance(spec, dict) and tag_type == 10:
+            result[name], pos = select_nbt_tags(data, pos, spec)
+        elif spec == NBT_LENGTH:
+            result[name] = nbt_payload_length(data, tag_type, pos)
+            pos = skip_nbt_payload(data, tag_type, pos)
+        else:
+            result[name], pos = decode_nbt_payload(data, tag_type, pos)
+
+        if stop_when_found and len(result) == len(wanted):
+            return result, None
+
+
+def read_nbt_tags(data, wanted):
+    """
+    Decodes the wanted tags of uncompressed NBT data in a single pass,
+    everything else is skipped by its length without creating objects.
+    :param wanted: tag name -> True to decode the tag, NBT_LENGTH for the
+    number of items of a list, array or compound, or a dict of the wanted
+    tags of a compound
+    :return: tag name -> value for the wanted tags that were found
+    """
+    if not data or data[0] != 10:
+        raise ValueError("NBT data does not start with a compound.")
+    pos = 3 + NBT_USHORT.unpack_from(data, 1)[0]
+    return select_nbt_tags(data, pos, wanted, stop_when_found=True)[0]
+
+
+def read_nbt_file(path, wanted):
+    """
+    Reads the wanted tags of a (usually gzip compressed) NBT file.
+    """
+    with open(path, "rb") as nbt_file:
+        data = nbt_file.read()
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return read_nbt_tags(data, wanted)
+
+
+# Label used for the players outside the active window, see
+# MinecraftCollector.collect_players. Not a valid Minecraft name.
+INACTIVE_PLAYER_LABEL = "(inactive)"
+# Counters that don't make sense summed up over players
+NON_ADDITIVE_METRICS = {'minecraft_advancement_data_version'}
+# Not exported, one sample per player and completed advancement for
+# minecraft_advancement_completion_ratio (ADVANCEMENT_COMPLETION_RATIO)
+ADVANCEMENT_DONE = 'minecraft_advancement_done'
+
+# player counter -> server-wide counter with the player label dropped,
+# see ServerAggregator
+SERVER_AGGREGATES = dict(
+    (metric, metric.replace('minecraft_', 'minecraft_server_', 1))
+    for metric, (family_class, _, _) in PLAYER_METRICS.items()
+    if family_class is CounterMetricFamily
+    and metric not in NON_ADDITIVE_METRICS)
+SERVER_AGGREGATE_METRICS = dict(
+    (SERVER_AGGREGATES[metric], (
+        family_class,
+        documentation + " Summed up over all players.",
+        label_names[1:]))
+    for metric, (family_class, documentation, label_names)
+    in PLAYER_METRICS.items() if metric in SERVER_AGGREGATES)
+
+
+def collapse_player_samples(samples, label=INACTIVE_PLAYER_LABEL):
+    """
+    Sums up the counter samples of several players into one player label,
+    gauges (health, position, ...) are dropped.
+    """
+    totals = dict()
+    for metric, labels, value in samples:
+        if metric not in SERVER_AGGREGATES and metric != ADVANCEMENT_DONE:
+            continue
+        key = (metric, (label,) + labels[1:])
+        totals[key] = totals.get(key, 0) + value
+    return [(metric, labels, value)
+            for (metric, labels), value in totals.items()]
+
+
+def build_metric_families(samples, definitions=PLAYER_METRICS):
+    """
+    Builds one metric family per metric name out of samples.
+    :param samples: An iterable of (metric name, label values, value)
+    :param definitions: metric name -> (family class, documentation, labels)
+    :return: The families that have samples, in the order of definitions
+    """
+    families = dict()
+    for metric, labels, value in samples:
+        entry = families.get(metric)
+        if entry is None:
+            if metric not in definitions:
+                # e.g. ADVANCEMENT_DONE, only used by the collector
+                families[metric] = False
+                continue
+            family_class, documentation, label_names = definitions[metric]
+            family = family_class(metric, documentation, labels=label_names)
+            # add_metric() is too slow for hundreds of thousands of samples
+            sample_name = family.name
+            if family.type == 'counter':
+                sample_name += '_total'
+            entry = (family, sample_name, label_names)
+            families[metric] = entry
+        elif entry is False:
+            continue
+        family, sample_name, label_names = entry
+        family.samples.append(Sample(
+            sample_name, dict(zip(label_names, labels)), value, None, None))
+
+    return [families[metric][0]
+            for metric in definitions if families.get(metric)]
+
+
+def compile_patterns(patterns):
+    """
+    Compiles glob patterns (minecraft:*_ore) and regular expressions
+    prefixed with re: into one regular expression matching any of them.
+    :return: The compiled expression, or None if there are no patterns
+    """
+    if not patterns:
+        return None
+    expressions = []
+    for pattern in patterns:
+        if pattern.startswith("re:"):
+            expressions.append("(?:%s)\\Z" % pattern[3:])
+        else:
+            expressions.append(fnmatch.translate(pattern))
+    return re.compile("|".join(expressions))
+
+
+class MetricFilter(object):
+    """
+    Decides which stat categories, stat IDs (blocks, items, entities and
+    custom stats) and advancement groups are exported.
+
+    Each has an allowlist and a denylist, see compile_patterns. If there is
+    an allowlist only the matching values are exported, and nothing that
+    matches the denylist is. The filter is passed to the readers, which may
+    run in worker processes, so it has to stay picklable.
+    """
+
+    def __init__(self, categories=None, exclude_categories=None,
+                 ids=None, exclude_ids=None,
+                 advancements=None, exclude_advancements=None):
+        self.categories = compile_patterns(categories)
+        self.exclude_categories = compile_patterns(exclude_categories)
+        self.ids = compile_patterns(ids)
+        self.exclude_ids = compile_patterns(exclude_ids)
+        self.advancements = compile_patterns(advancements)
+        self.exclude_advancements = compile_patterns(exclude_advancements)
+        # lets the readers skip the check for every single stat
+        self.filters_ids = \
+            self.ids is not None or self.exclude_ids is not None
+
+    @staticmethod
+    def allows(value, include, exclude):
+        return (include is None or include.match(value) is not None) and \
+            (exclude is None or exclude.match(value) is None)
+
+    def allows_category(self, category):
+        return self.allows(
+            category, self.categories, self.exclude_categories)
+
+    def allows_id(self, stat_id):
+        return self.allows(stat_id, self.ids, self.exclude_ids)
+
+    def allows_advancement_group(self, group):
+        return self.allows(
+            group, self.advancements, self.exclude_advancements)
+
+    @staticmethod
+    def from_env():
+        """
+        Reads the lists from the JSON file FILTER_CONFIG, each can be
+        replaced by a comma separated environment variable.
+        :return: A MetricFilter, or None if nothing is filtered
+        """
+        config = dict()
+        path = os.environ.get("FILTER_CONFIG")
+        if path:
+            with open(path) as config_file:
+                config = json.load(config_file)
+
+        lists = dict()
+        for section, argument, variable in (
+                ("stat_categories", "categories", "FILTER_STAT_CATEGORIES"),
+                ("stat_ids", "ids", "FILTER_STAT_IDS"),
+                ("advancements", "advancements", "FILTER_ADVANCEMENTS")):
+            for kind, prefix, suffix in (("include", "", ""),
+                                         ("exclude", "exclude_", "_EXCLUDE")):
+                patterns = config.get(section, dict()).get(kind)
+                value = os.environ.get(variable + suffix)
+                if value is not None:
+                    patterns = [pattern.strip() for pattern in
+                                value.split(",") if pattern.strip()]
+                lists[prefix + argument] = patterns
+
+        if not any(lists.values()):
+            return None
+        return MetricFilter(**lists)
+
+
+# advancement category -> group of the minecraft_advancement_*_count
+# metrics, advancements in any other category count as "other"
+ADVANCEMENT_CATEGORY_GROUPS = {
+    "story": "story",
+    "nether": "nether",
+    "end": "end",
+    "adventure": "adventure",
+    "husbandry": "husbandry",
+    "recipes": "recipe",
+}
+# advancement -> (namespace, category, group), see classify_advancement
+ADVANCEMENT_CLASSES = dict()
+ADVANCEMENT_COMPLETION_RATIO = \
+    os.environ.get("ADVANCEMENT_COMPLETION_RATIO", "false") == "true"
+
+
+def classify_advancement(key):
+    """
+    Splits an advancement ID (namespace:category/path) into its namespace
+    and category, e.g. ("minecraft", "story") for minecraft:story/mine_stone.
+    Memoized, as all players share the same few hundred advancements.
+    :return: (namespace, category, group)
+    """
+    result = ADVANCEMENT_CLASSES.get(key)
+    if result is None:
+        namespace, _, path = key.rpartition(":")
+        category, slash, _ = path.partition("/")
+        if not slash:
+            category = "none"
+        result = (namespace or "minecraft", category,
+                  ADVANCEMENT_CATEGORY_GROUPS.get(category, "other"))
+        ADVANCEMENT_CLASSES[key] = result
+    return result
+
+
+# advancement group -> metric, in the order they are exported
+ADVANCEMENT_GROUP_METRICS = (
+    ("story", 'minecraft_advancement_story_count'),
+    ("nether", 'minecraft_advancement_nether_count'),
+    ("end", 'minecraft_advancement_end_count'),
+    ("adventure", 'minecraft_advancement_adventure_count'),
+    ("husbandry", 'minecraft_advancement_husbandry_count'),
+    ("recipe", 'minecraft_advancement_recipe_count'),
+    ("other", 'minecraft_advancement_other_count'),
+)
+
+
+# ijson needs less memory for big advancements and stats files, but is
+# slower than the json module, so it is only used if asked for
+STREAM_JSON = os.environ.get("JSON_DECODER", "json") == "ijson"
+if STREAM_JSON and ijson is None:
+    m_logger.warning("JSON_DECODER=ijson, but ijson is not installed.")
+    STREAM_JSON = False
+
+
+def collapse_advancement_pairs(pairs):
+    """
+    object_pairs_hook for advancements files that turns every advancement
+    into its done flag and drops the criteria maps (criterion -> time), so
+    that neither is ever built as a dict.
+    """
+    if pairs and isinstance(pairs[0][1], str):
+        return None
+    for key, _ in pairs:
+        # advancements are namespaced, this can't be one
+        if key == "criteria":
+            for field, value in pairs:
+                if field == "done":
+                    return value is True
+            return False
+    return dict(pairs)
+
+
+def load_advancements(json_file):
+    """
+    Streams an advancements file with ijson (JSON_DECODER=ijson), or
+    decodes it with collapse_advancement_pairs otherwise.
+    :param json_file: The file opened in binary mode
+    :return: advancement -> done, plus "DataVersion" -> the data version
+    """
+    if not STREAM_JSON:
+        return json.load(
+            json_file, object_pairs_hook=collapse_advancement_pairs)
+
+    advancements = dict()
+    depth = 0
+    key = field = None
+    for event, value in ijson.basic_parse(json_file, use_float=True):
+        if event == "map_key":
+            if depth == 1:
+                key = value
+            elif depth == 2:
+                field = value
+        elif event == "start_map" or event == "start_array":
+            depth += 1
+        elif event == "end_map" or event == "end_array":
+            depth -= 1
+        elif depth == 1:
+            advancements[key] = value
+        elif depth == 2 and field == "done":
+            advancements[key] = value is True
+    return advancements
+
+
+def read_player_advancements(advancements_file_path, name,
+                             metric_filter=None):
+    with open(advancements_file_path, "rb") as json_file:
+        advancements = load_advancements(json_file)
+
+    data_version = advancements.pop("DataVersion", 0)
+    done = [key for key, value in advancements.items() if value is True]
+    group_counts = defaultdict(int)
+    category_counts = defaultdict(int)
+    for key in done:
+        namespace, category, group = classify_advancement(key)
+        group_counts[group] += 1
+        category_counts[(namespace, category, group)] += 1
+
+    allows = None
+    if metric_filter is not None:
+        allows = metric_filter.allows_advancement_group
+
+    result = [('minecraft_advancement_data_version', (name,), data_version)]
+    for group, metric in ADVANCEMENT_GROUP_METRICS:
+        if allows is None or allows(group):
+            result.append((metric, (name,), group_counts[group]))
+    for (namespace, category, group), count in category_counts.items():
+        if allows is None or allows(group):
+            result.append(('minecraft_advancements_completed',
+                           (name, namespace, category), count))
+    if ADVANCEMENT_COMPLETION_RATIO:
+        for key in done:
+            if allows is None or allows(classify_advancement(key)[2]):
+                result.append((ADVANCEMENT_DONE, (name, key), 1))
+    return result
+
+
+# playerdata tag -> metric, only these tags are decoded
+PLAYER_DATA_TAGS = {
+    "Score": 'minecraft_score',
+    "XpTotal": 'minecraft_xp_total',
+    "XpLevel": 'minecraft_current_level',
+    "Health": 'minecraft_health',
+    "foodLevel": 'minecraft_food_level',
+    "foodSaturationLevel": 'minecraft_food_saturation_level',
+    "foodExhaustionLevel": 'minecraft_food_exhaustion_level',
+    "playerGameType": 'minecraft_game_type',
+    "Dimension": 'minecraft_dimension',
+}
+PLAYER_DATA_WANTED = {tag: True for tag in PLAYER_DATA_TAGS}
+
+
+def read_player_data(player_data_file_path, name, metric_filter=None):
+    result = []
+    tags = read_nbt_file(player_data_file_path, PLAYER_DATA_WANTED)
+
+    for tag, metric in PLAYER_DATA_TAGS.items():
+        if tag not in tags:
+            continue
+        if tag == "Dimension":
+            # Give a unique value (1-3) for each default dimension
+            # and 4 for anything custom. Makes it easier to graph.
+            dimension = tags[tag]
+            result.append((metric, (name, str(dimension)),
+                           get_dimension_value(dimension)))
+        else:
+            result.append((metric, (name,), tags[tag]))
+
+    return result
+
+
+def load_stats(json_file, metric_filter=None):
+    """
+    Streams a stats file with ijson (JSON_DECODER=ijson), leaving out the
+    stats that are not exported, or decodes all of it otherwise.
+    :param json_file: The file opened in binary mode
+    :return: category -> stat -> value, or None if there are no stats
+    """
+    if not STREAM_JSON:
+        return json.load(json_file).get("stats")
+
+    stats = None
+    values = None
+    filter_ids = metric_filter is not None and metric_filter.filters_ids
+    depth = 0
+    keys = [None, None, None]
+    for event, value in ijson.basic_parse(json_file, use_float=True):
+        if event == "map_key":
+            if depth <= 3:
+                keys[depth - 1] = value
+        elif event == "start_map" or event == "start_array":
+            depth += 1
+            if keys[0] != "stats":
+                continue
+            if depth == 2:
+                stats = dict()
+            elif depth == 3:
+                category = keys[1]
+                values = None
+                if (category in STATS_CATEGORY_METRICS or
+                        category == "minecraft:custom") and \
+                        (metric_filter is None or
+                         metric_filter.allows_category(category)):
+                    values = stats[category] = dict()
+        elif event == "end_map" or event == "end_array":
+            depth -= 1
+        elif depth == 3 and values is not None and keys[0] == "stats":
+            if not filter_ids or metric_filter.allows_id(keys[2]):
+                values[keys[2]] = value
+    return stats
+
+
+def read_player_stats(player_stats_file_path, name, metric_filter=None):
+    result = []
+
+    with open(player_stats_file_path, "rb") as json_file:
+        stats = load_stats(json_file, metric_filter)
+
+    # I can't think of a reason why I'd ever play an older version
+    # hence removal of pre 1.15 code block.
+    if stats is None:
+        m_logger.error(
+            "No stats key in file %s." % player_stats_file_path)
+    else:
+
+        filter_ids = metric_filter is not None and metric_filter.filters_ids
+        for category, metric in STATS_CATEGORY_METRICS.items():
+            if category not in stats or metric_filter is not None and \
+                    not metric_filter.allows_category(category):
+                continue
+            for key, value in stats[category].items():
+                if filter_ids and not metric_filter.allows_id(key):
+                    continue
+                result.append((metric, (name, key), value))
+
+        custom_stats = stats.get("minecraft:custom", dict())
+        if metric_filter is not None and \
+                not metric_filter.allows_category("minecraft:custom"):
+            custom_stats = dict()
+
+        # Grab the custom stats
+        for custom_stat, value in custom_stats.items():
+            if filter_ids and not metric_filter.allows_id(custom_stat):
+                continue
+            if custom_stat.endswith("one_cm"):
+                metric = 'minecraft_distance_traveled_cm_total'
+            elif custom_stat.startswith("minecraft:interact"):
+                metric = 'minecraft_interactions_total'
+            elif custom_stat.startswith("minecraft:damage"):
+                metric = 'minecraft_damage_total'
+            else:
+                metric = 'minecraft_custom'
+            result.append((metric, (name, custom_stat), value))
+
+    return result
+
+
+class ParseCache(object):
+    """
+    Keeps the samples read from a file until that file changes on disk.
+
+    Entries are keyed on the file's (inode, mtime_ns, size) plus any extra
+    arguments passed to the parser, so a file is only re-parsed after the
+    server rewrites it. If a PlayerFileWatcher reports changes through
+    invalidate(), the cache is trusted and unchanged files are not even
+    stat'ed.
+    """
+
     def __init__(self):
-        # Can move this around or add handlers as needed
-        self.logger = logging.getLogger(__name__)
+        self.entries = dict()
+        self.seen = set()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.trusted = False
+        self.dirty = set()
+
+    def invalidate(self, path):
+        """
+        Marks a file as changed, called by the watcher thread.
+        """
+        self.dirty.add(path)
 
-        world_directory = os.environ.get("WORLD_DIR", "/world")
-        self.stats_directory = "%s/stats" % world_directory
-        self.player_directory = "%s/playerdata" % world_directory
-        self.advancements_directory = "%s/advancements" % world_directory
-        self.rcon_enabled = False
-        self.enable_rcon()
-        self.uuid_name_map = dict()
+    def lookup(self, source, path, *args):
+        """
+        Looks up a file without parsing it.
+        :return: (key, result) - key is None if the file does not exist,
+        result is None if the file has to be (re-)parsed
+        """
+        entry = self.entries.get(path)
+        if self.trusted and entry is not None and \
+                path not in self.dirty and entry[0][3:] == args:
+            self.seen.add(path)
+            self.hits[source] += 1
+            return entry[0], entry[1]
+        # Discarded before the stat, so a change that happens while the
+        # file is parsed marks it dirty again
+        self.dirty.discard(path)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.entries.pop(path, None)
+            return None, None
+
+        self.seen.add(path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size) + args
+        if entry is not None and entry[0] == key:
+            self.hits[source] += 1
+            return key, entry[1]
+
+        self.misses[source] += 1
+        return key, None
+
+    def store(self, path, key, result):
+        self.entries[path] = (key, result)
 
-        schedule.every(24).hours.do(self.flush_player_uuid_name_map)
+    def get(self, source, path, parser, *args):
+        """
+        Returns the cached result of parser(path, *args), re-parsing if the
+        file changed since it was last seen.
+        :return: The parser result or None if the file does not exist
+        """
+        key, result = self.lookup(source, path, *args)
+        if key is not None and result is None:
+            result = parser(path, *args)
+            self.store(path, key, result)
+        return result
 
-    def enable_rcon(self):
+    def mtime(self, path):
         """
-        Enables RCON if all 3 RCON env vars are passed in.
-        :return: schedule.CancelJob - To ensure is only enabled once
+        :return: The modification time of a file, without a stat if the
+        cache is trusted, or None if the file does not exist
         """
-        self.rcon_enabled = all(x in os.environ for x in [
-            'RCON_HOST', 'RCON_PASSWORD', 'RCON_PORT']
-        )
-        return schedule.CancelJob
+        entry = self.entries.get(path)
+        if self.trusted and entry is not None and path not in self.dirty:
+            return entry[0][1] / 1e9
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
 
-    def get_players(self):
-        if not isdir(self.stats_directory):
-            self.logger.warning(
-                "No stats!"
-                "\nTry joining the server."
-                "\nHave you mounted the world into the container?"
-            )
-            return []
+    def keep(self, path):
+        """
+        Keeps an entry that was not looked up from being evicted.
+        """
+        self.seen.add(path)
+
+    def evict_unseen(self):
+        """
+        Drops entries for files that were not looked up since the last
+        eviction, e.g. because the player's files were deleted.
+        """
+        for path in set(self.entries) - self.seen:
+            del self.entries[path]
+        self.seen = set()
+
+    def get_metrics(self):
+        hits = CounterMetricFamily(
+            'minecraft_exporter_parse_cache_hits',
+            "The number of file lookups served from the parse cache.",
+            labels=['source'])
+        misses = CounterMetricFamily(
+            'minecraft_exporter_parse_cache_misses',
+            "The number of file lookups that required a re-parse.",
+            labels=['source'])
+        entries = GaugeMetricFamily(
+            'minecraft_exporter_parse_cache_entries',
+            "The number of files currently held in the parse cache.")
+
+        for source in sorted(set(self.hits) | set(self.misses)):
+            hits.add_metric([source], self.hits[source])
+            misses.add_metric([source], self.misses[source])
+        entries.add_metric([], len(self.entries))
+
+        return [hits, misses, entries]
+
+
+class ServerAggregator(object):
+    """
+    Keeps the server-wide sums of the player counters (SERVER_AGGREGATES
+    by default).
+
+    Every contribution (the samples of one player file) is remembered, when
+    a different list is passed for the same key its old values are
+    subtracted and the new ones added, so only changed files cost anything.
+    Unchanged files hand out the same list from the ParseCache.
+    """
+
+    def __init__(self, aggregates=SERVER_AGGREGATES):
+        self.aggregates = aggregates
+        self.contributions = dict()
+        self.seen = set()
+        # (server metric, labels) -> [sum, number of contributing samples]
+        self.totals = dict()
+
+    def update(self, key, samples):
+        self.seen.add(key)
+        previous = self.contributions.get(key)
+        if previous is samples:
+            return
+        if previous is not None:
+            self.add(previous, -1)
+        self.add(samples, 1)
+        self.contributions[key] = samples
+
+    def add(self, samples, sign):
+        totals = self.totals
+        for metric, labels, value in samples:
+            server_metric = self.aggregates.get(metric)
+            if server_metric is None:
+                continue
+            key = (server_metric, labels[1:])
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = [0, 0]
+            total[0] += sign * value
+            total[1] += sign
+            if total[1] == 0:
+                del totals[key]
+
+    def evict_unseen(self):
+        """
+        Subtracts the contributions not updated since the last call, e.g.
+        of deleted players.
+        """
+        for key in list(self.contributions):
+            if key not in self.seen:
+                self.add(self.contributions.pop(key), -1)
+        self.seen = set()
+
+    def get_samples(self):
+        return [(metric, labels, total[0])
+                for (metric, labels), total in self.totals.items()]
+
+
+class NameResolver(object):
+    """
+    Resolves player UUIDs to names through the Mojang API in a background
+    thread, so looking up a name never blocks on the network.
+
+    Resolved names are kept for NAME_CACHE_TTL seconds and persisted to
+    NAME_CACHE_FILE if set. Expired names are still served while they are
+    being refreshed, UUIDs the API does not know are remembered for
+    NAME_CACHE_NEGATIVE_TTL seconds. Failed lookups (API down, timeouts)
+    are retried after NAME_CACHE_RETRY_INTERVAL seconds, doubled with every
+    further failure in a row up to NAME_CACHE_NEGATIVE_TTL.
+    """
+
+    def __init__(self, cache_file=None, api_url=MOJANG_API_PROFILE_URL,
+                 ttl=7 * 24 * 3600, negative_ttl=3600,
+                 rate_limit=2.0, timeout=5.0, retry_interval=60):
+        self.logger = logging.getLogger(__name__)
+        self.cache_file = cache_file
+        self.api_url = api_url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.retry_interval = retry_interval
+        # failed lookups in a row, for the retry backoff
+        self.failures = 0
+        self.interval = 1.0 / rate_limit if rate_limit > 0 else 0.0
+        self.timeout = timeout
+
+        self.request_durations = Histogram(
+            'minecraft_exporter_mojang_request_duration_seconds',
+            "Seconds the Mojang API took to answer, including failures.",
+            registry=None)
+        self.lock = threading.Lock()
+        # uuid -> {"name": name or None if unknown, "expires": timestamp}
+        self.entries = dict()
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lookups = defaultdict(int)
+        self.session = requests.Session()
+        self.last_request = 0.0
+        self.thread = None
+
+        self.load()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            cache_file=os.environ.get("NAME_CACHE_FILE"),
+            api_url=os.environ.get("MOJANG_API_URL", MOJANG_API_PROFILE_URL),
+            ttl=float(os.environ.get("NAME_CACHE_TTL", 7 * 24 * 3600)),
+            negative_ttl=float(
+                os.environ.get("NAME_CACHE_NEGATIVE_TTL", 3600)),
+            rate_limit=float(os.environ.get("MOJANG_API_RATE_LIMIT", 2.0)),
+            timeout=float(os.environ.get("MOJANG_API_TIMEOUT", 5.0)),
+            retry_interval=float(
+                os.environ.get("NAME_CACHE_RETRY_INTERVAL", 60)))
+
+    def load(self):
+        if not self.cache_file or not isfile(self.cache_file):
+            return
+
+        # noinspection PyBroadException
+        try:
+            with open(self.cache_file) as json_file:
+                self.entries = json.load(json_file)
+            self.logger.info("Loaded %i names from %s." % (
+                len(self.entries), self.cache_file))
+        except Exception:
+            self.logger.exception(
+                "Loading name cache %s failed." % self.cache_file)
+
+    def save(self):
+        if not self.cache_file:
+            return
+
+        with self.lock:
+            data = json.dumps(self.entries)
+        temp_file = self.cache_file + ".tmp"
+        # noinspection PyBroadException
+        try:
+            with open(temp_file, "w") as json_file:
+                json_file.write(data)
+            os.replace(temp_file, self.cache_file)
+        except Exception:
+            self.logger.exception(
+                "Saving name cache %s failed." % self.cache_file)
+
+    def get(self, uuid):
+        """
+        :return: The cached name or None, in which case a lookup is queued
+        """
+        with self.lock:
+            entry = self.entries.get(uuid)
+            if entry is None or entry["expires"] < time.time():
+                self.enqueue(uuid)
+        if entry is None:
+            return None
+        return entry["name"]
+
+    def enqueue(self, uuid):
+        # Caller holds self.lock
+        if uuid in self.pending:
+            return
+        self.pending.add(uuid)
+        self.queue.put(uuid)
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="name-resolver", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            # Resolve whatever queued up and persist the cache once per batch
+            batch = [self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            for uuid in batch:
+                self.resolve(uuid)
+                with self.lock:
+                    self.pending.discard(uuid)
+            self.save()
+
+    def resolve(self, uuid):
+        wait = self.last_request + self.interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_request = time.time()
+
+        name = None
+        ttl = self.negative_ttl
+        start = time.time()
+        # noinspection PyBroadException
+        try:
+            response = self.session.get(
+                self.api_url % uuid, timeout=self.timeout)
+            if response.status_code == 200:
+                name = self.parse_response(response.json())
+                result = "resolved" if name else "not_found"
+            elif response.status_code in (204, 404):
+                result = "not_found"
+            else:
+                result = "failed"
+                self.logger.warning(
+                    "UUID lookup failed for %s: API returned %i." % (
+                        uuid, response.status_code))
+        except Exception as e:
+            result = "failed"
+            self.logger.warning("UUID lookup failed for %s: %s" % (uuid, e))
+        self.request_durations.observe(time.time() - start)
+
+        self.lookups[result] += 1
+        if result == "failed":
+            self.failures += 1
+            ttl = min(self.retry_interval * 2 ** min(self.failures - 1, 16),
+                      self.negative_ttl)
         else:
-            return [f[:-5] for f in listdir(self.stats_directory) if isfile(join(self.stats_directory, f))]
+            self.failures = 0
+        with self.lock:
+            entry = self.entries.get(uuid)
+            if name:
+                ttl = self.ttl
+            elif result == "failed" and entry is not None:
+                # Keep serving the stale name until the API is back
+                name = entry["name"]
+            self.entries[uuid] = {"name": name, "expires": time.time() + ttl}
+
+        self.logger.debug("Got %s as username for %s from Mojang API." % (
+            name, uuid))
+
+    @staticmethod
+    def parse_response(data):
+        # The session server returns the profile, the retired names
+        # endpoint returned the history of names.
+        if isinstance(data, dict):
+            return data.get("name")
+        for change in data:
+            if 'changedToAt' not in change and 'name' in change:
+                return change['name']
+        return None
+
+    def get_metrics(self):
+        entries = GaugeMetricFamily(
+            'minecraft_exporter_name_cache_entries',
+            "The number of UUIDs in the name cache.")
+        pending = GaugeMetricFamily(
+            'minecraft_exporter_name_lookups_pending',
+            "The number of UUIDs waiting to be looked up.")
+        lookups = CounterMetricFamily(
+            'minecraft_exporter_name_lookups',
+            "The number of Mojang API lookups by result.",
+            labels=['result'])
+
+        with self.lock:
+            entries.add_metric([], len(self.entries))
+            pending.add_metric([], len(self.pending))
+        for result in sorted(self.lookups):
+            lookups.add_metric([result], self.lookups[result])
+
+        return [entries, pending, lookups] + self.request_durations.collect()
+
+
+class UserCache(object):
+    """
+    Indexes the usercache.json the server keeps next to the world, so most
+    names can be resolved without asking the Mojang API.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.mtime = None
+        self.names = dict()
 
-    def flush_player_uuid_name_map(self):
-        self.logger.info("Flushing player UUID to name map.")
-        self.uuid_name_map = dict()
-        return
+    def reload(self):
+        """
+        Re-reads the file if its modification time changed.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.mtime = None
+            self.names = dict()
+            return
+        if mtime == self.mtime:
+            return
+
+        # noinspection PyBroadException
+        try:
+            with open(self.path) as json_file:
+                entries = json.load(json_file)
+            self.names = {entry["uuid"]: entry["name"] for entry in entries}
+            self.mtime = mtime
+            self.logger.debug("Loaded %i names from %s." % (
+                len(self.names), self.path))
+        except Exception:
+            self.logger.exception("Loading %s failed." % self.path)
 
-    def uuid_to_player(self, uuid):
-        result = uuid
-        if uuid in self.uuid_name_map:
-            result = self.uuid_name_map[uuid]
-            self.logger.debug(
-                "Got %s as username for %s from local cache." % (uuid, result)
-            )
-        else:
-            response = requests.get(MOJANG_API_NAMES_URL % uuid)
+    def get(self, uuid):
+        return self.names.get(uuid)
 
-            if response.status_code == 200:
-                # noinspection PyBroadException
-                try:
-                    history = response.json()
-                    for change in history:
-                        if 'changedToAt' not in change and 'name' in change:
-                            self.uuid_name_map[uuid] = change['name']
-                            result = change['name']
-                            break
-                except Exception:
-                    self.logger.exception(
-                        "Parsing of Mojang API response failed.")
 
-                self.logger.debug(
-                    "Got %s as username for %s from Mojang API."
-                    % (uuid, result))
-            else:
+class RconError(Exception):
+    pass
+
+
+class RconClient(object):
+    """
+    Keeps a single RCON connection to the server open.
+
+    Connecting, reconnecting with exponential backoff and health checks all
+    happen in a background thread. While the connection is down the circuit
+    is open and command() fails immediately instead of blocking a scrape.
+    """
+
+    CIRCUIT_CLOSED = 0
+    CIRCUIT_HALF_OPEN = 1
+    CIRCUIT_OPEN = 2
+
+    PACKET_COMMAND = 2
+    PACKET_LOGIN = 3
+
+    def __init__(self, host, port, password, timeout=5.0,
+                 health_interval=30.0, min_backoff=1.0, max_backoff=300.0):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.socket = None
+        self.request_id = 0
+        self.last_used = 0.0
+        self.state = self.CIRCUIT_OPEN
+        self.backoff = min_backoff
+        self.retry_at = 0.0
+        self.command_durations = Histogram(
+            'minecraft_exporter_rcon_command_duration_seconds',
+            "Seconds RCON commands took, including failures.",
+            registry=None)
+        self.commands = defaultdict(int)
+        self.connects = defaultdict(int)
+        self.thread = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        :return: A client if RCON_HOST and RCON_PASSWORD are set, else None
+        """
+        if not all(x in os.environ for x in ['RCON_HOST', 'RCON_PASSWORD']):
+            return None
+        return cls(
+            os.environ['RCON_HOST'],
+            int(os.environ.get('RCON_PORT', 25575)),
+            os.environ['RCON_PASSWORD'],
+            timeout=float(os.environ.get('RCON_TIMEOUT', 5.0)))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="rcon", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            now = time.time()
+            # noinspection PyBroadException
+            try:
+                if self.state == self.CIRCUIT_OPEN and now >= self.retry_at:
+                    self.reconnect()
+                elif self.state == self.CIRCUIT_CLOSED and \
+                        now - self.last_used >= self.health_interval:
+                    try:
+                        self.command("list")
+                    except RconError:
+                        pass
+            except Exception:
+                self.logger.exception("RCON connection check failed.")
+            time.sleep(1)
+
+    def reconnect(self):
+        with self.lock:
+            self.state = self.CIRCUIT_HALF_OPEN
+            self.disconnect()
+            try:
+                self.socket = socket.create_connection(
+                    (self.host, self.port), timeout=self.timeout)
+                self.send(self.PACKET_LOGIN, self.password)
+            except (OSError, RconError) as e:
+                self.disconnect()
+                self.state = self.CIRCUIT_OPEN
+                self.retry_at = time.time() + self.backoff
                 self.logger.error(
-                    "UUID lookup failed for %s.\n"
-                    "API returned %i - %s." % (
-                        uuid, response.status_code, response.text)
-                )
-                self.logger.warning("Using UUID instead of username.")
+                    "RCON connection to %s:%i failed (%s), is the server up?"
+                    " Retrying in %is." % (
+                        self.host, self.port, e, self.backoff))
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self.connects["failed"] += 1
+                return
+
+            self.state = self.CIRCUIT_CLOSED
+            self.backoff = self.min_backoff
+            self.last_used = time.time()
+            self.connects["success"] += 1
+            self.logger.info(
+                "RCON connected to %s:%i." % (self.host, self.port))
+
+    def disconnect(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def command(self, command):
+        """
+        Runs a command on the open connection.
+        :return: The response text
+        :raises RconError: If not connected or the command failed
+        """
+        with self.lock:
+            if self.state != self.CIRCUIT_CLOSED:
+                self.commands["rejected"] += 1
+                raise RconError("RCON is not connected.")
+
+            self.logger.debug("Running RCON command: %s" % command)
+            start = time.time()
+            try:
+                result = self.send(self.PACKET_COMMAND, command)
+            except (OSError, RconError) as e:
+                self.command_durations.observe(time.time() - start)
+                # The connection is in an unknown state, start over
+                self.disconnect()
+                self.state = self.CIRCUIT_OPEN
+                self.retry_at = time.time() + self.backoff
+                self.commands["failed"] += 1
+                raise RconError("RCON command %s failed: %s" % (command, e))
+
+            self.last_used = time.time()
+            self.command_durations.observe(self.last_used - start)
+            self.commands["success"] += 1
+            self.logger.debug("RCON result was: %s" % result)
+            return result
 
+    def send(self, packet_type, body):
+        self.request_id += 1
+        request_id = self.request_id
+        self.write_packet(request_id, packet_type, body)
+        if packet_type == self.PACKET_LOGIN:
+            response_id, _ = self.read_packet()
+            if response_id == -1:
+                raise RconError("RCON login failed.")
+            return None
+
+        # Long responses are split into several packets, an invalid request
+        # sent right after the command marks where the response ends.
+        self.request_id += 1
+        self.write_packet(self.request_id, 0, "")
+        result = ""
+        while True:
+            response_id, payload = self.read_packet()
+            if response_id == self.request_id:
+                return result
+            if response_id == request_id:
+                result += payload
+
+    def write_packet(self, request_id, packet_type, body):
+        payload = struct.pack("<ii", request_id, packet_type) + \
+            body.encode("utf8") + b"\x00\x00"
+        self.socket.sendall(struct.pack("<i", len(payload)) + payload)
+
+    def read_packet(self):
+        length, = struct.unpack("<i", self.read_exactly(4))
+        # id, type, body of up to 4096 bytes and two null bytes
+        if not 10 <= length <= 4096 + 10:
+            raise RconError(
+                "Invalid RCON packet length %i, is this an RCON port?"
+                % length)
+        payload = self.read_exactly(length)
+        response_id, _ = struct.unpack("<ii", payload[:8])
+        return response_id, payload[8:-2].decode("utf8", "replace")
+
+    def read_exactly(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise RconError("RCON connection closed by server.")
+            data += chunk
+        return data
+
+    def get_metrics(self):
+        state = GaugeMetricFamily(
+            'minecraft_exporter_rcon_circuit_state',
+            "The state of the RCON circuit breaker."
+            " 0 is closed (connected), 1 is half-open (connecting)"
+            " and 2 is open (disconnected).")
+        commands = CounterMetricFamily(
+            'minecraft_exporter_rcon_commands',
+            "The number of RCON commands by result.",
+            labels=['result'])
+        connects = CounterMetricFamily(
+            'minecraft_exporter_rcon_connects',
+            "The number of RCON connection attempts by result.",
+            labels=['result'])
+
+        state.add_metric([], self.state)
+        for result in sorted(self.commands):
+            commands.add_metric([result], self.commands[result])
+        for result in sorted(self.connects):
+            connects.add_metric([result], self.connects[result])
+
+        return [state, commands, connects] + \
+            self.command_durations.collect()
+
+
+# Metrics produced by the RCON parsers, see RconParser
+SERVER_METRICS = {
+    'minecraft_player_online': (
+        GaugeMetricFamily,
+        "The value is 1 if player is online, missing if not.",
+        ['player']),
+    'minecraft_players_online': (
+        GaugeMetricFamily,
+        "The number of players online.",
+        []),
+    'minecraft_players_max': (
+        GaugeMetricFamily,
+        "The maximum number of players allowed online.",
+        []),
+    'minecraft_tps': (
+        GaugeMetricFamily,
+        "Ticks per second averaged over a window, 20 is the maximum.",
+        ['dimension', 'window']),
+    'minecraft_mspt_milliseconds': (
+        GaugeMetricFamily,
+        "Milliseconds per tick over a window, above 50 the server lags.",
+        ['dimension', 'window', 'stat']),
+    'minecraft_tick_rate_target': (
+        GaugeMetricFamily,
+        "The number of ticks per second the server is trying to run.",
+        []),
+    'minecraft_entities_loaded': (
+        GaugeMetricFamily,
+        "The number of loaded entities.",
+        ['dimension']),
+    'minecraft_chunks_loaded': (
+        GaugeMetricFamily,
+        "The number of loaded chunks.",
+        ['dimension']),
+    'minecraft_chunks_ticking': (
+        GaugeMetricFamily,
+        "The number of loaded chunks that are ticking.",
+        ['dimension']),
+}
+
+# Matches formatting codes like §6 that some servers put into the output
+FORMATTING_REGEX = re.compile("§.")
+
+
+class RconParser(object):
+    """
+    Turns the output of RCON commands into samples of SERVER_METRICS.
+
+    Subclasses list the commands to run and precompile their patterns as
+    class attributes, parse() is called with the output of each command.
+    """
+
+    commands = ()
+
+    def parse(self, command, output):
+        raise NotImplementedError
+
+
+class ListParser(RconParser):
+    """
+    The player list, e.g. "There are 2 of a max of 20 players online: a, b",
+    before 1.13 "There are 2/20 players online:" with the names on the
+    next line.
+    """
+
+    commands = ("list",)
+    count_regex = re.compile(
+        r"There are (\d+) ?(?:of a max of|out of maximum|/) ?(\d+) players")
+    player_regex = re.compile("players online:(.*)")
+    # Paper lists the players by group on the following lines
+    group_regex = re.compile(r"(?m)^[^:\n]+: (.*)$")
+
+    def parse(self, command, output):
+        result = []
+        output = FORMATTING_REGEX.sub("", output)
+        match = self.count_regex.search(output)
+        if match:
+            result.append(('minecraft_players_online', (), int(match[1])))
+            result.append(('minecraft_players_max', (), int(match[2])))
+
+        players = [names for names in self.player_regex.findall(output)
+                   if names.strip()]
+        if not players and match:
+            rest = output[match.end():]
+            players = self.group_regex.findall(rest) or rest.split("\n")[1:]
+        for player in ",".join(players).split(","):
+            if player and not player.isspace():
+                result.append(
+                    ('minecraft_player_online', (player.strip(),), 1))
         return result
 
-    @retry((ConnectionRefusedError, Exception), tries=15, delay=2)
-    def rcon_command(self, command):
-        if not self.rcon_enabled:
-            self.logger.debug("RCON disabled.")
-            return None
 
-        try:
-            self.logger.debug("Attempting to run RCON command: %s" % command)
-            with MCRcon(os.environ['RCON_HOST'],
-                        os.environ['RCON_PASSWORD'],
-                        port=int(os.environ['RCON_PORT'])) as mcr:
-                result = mcr.command(command)
-                self.logger.debug("RCON result was: %s" % result)
-        except ConnectionRefusedError as cre:
-            self.logger.error("RCON connection refused, is the server up?")
-            raise cre
+class ForgeTpsParser(RconParser):
+    """
+    Forge's "forge tps", one line per dimension plus an overall line, e.g.
+    "Dim minecraft:overworld (minecraft:overworld): Mean tick time: 0.5 ms.
+    Mean TPS: 20.000"
+    """
+
+    commands = ("forge tps",)
+    line_regex = re.compile(
+        r"(?m)^\s*(.*?)\s*:\s*Mean tick time: ([\d.]+) ms\.?"
+        r"\s*Mean TPS: ([\d.]+)")
+    dimension_regex = re.compile(r"\(([^)]+)\)|^(?:Dim\s+)?(\S+)$")
 
+    def parse(self, command, output):
+        result = []
+        for match in self.line_regex.finditer(output):
+            dimension = self.dimension_regex.search(match[1])
+            if match[1] == "Overall" or not dimension:
+                dimension = "overall"
+            else:
+                dimension = dimension[1] or dimension[2]
+            # Forge averages over the last 100 ticks
+            result.append(('minecraft_mspt_milliseconds',
+                           (dimension, "100t", "mean"), float(match[2])))
+            result.append(('minecraft_tps',
+                           (dimension, "100t"), float(match[3])))
         return result
 
-    def get_server_stats(self):
-        metrics = []
-        if not all(x in os.environ for x in ['RCON_HOST', 'RCON_PASSWORD']):
-            self.logger.warning(
-                "RCON_HOST and/or RCON_password are not defined."
-                "\nServer stats not available."
-            )
+
+class PaperTpsParser(RconParser):
+    """
+    Paper's and Spigot's "tps", e.g.
+    "TPS from last 1m, 5m, 15m: 20.0, 19.98, *20.0"
+    """
+
+    commands = ("tps",)
+    tps_regex = re.compile(r"TPS from last ([^:]+):\s*(.+)")
+
+    def parse(self, command, output):
+        match = self.tps_regex.search(FORMATTING_REGEX.sub("", output))
+        if not match:
             return []
-        player_online = GaugeMetricFamily(
-            'minecraft_player_online',
-            "The value is 1 if player is online, missing if not.",
-            labels=['player'])
 
-        metrics.append(player_online)
+        windows = [window.strip() for window in match[1].split(",")]
+        values = [value.strip(" *") for value in match[2].split(",")]
+        return [('minecraft_tps', ("overall", window), float(value))
+                for window, value in zip(windows, values)]
 
-        # player
-        try:
-            resp = self.rcon_command("list")
-        except ConnectionRefusedError:
-            logger.error("Could not connect via RCON after 30 seconds."
-                         "Will try again in 1 hour, or restart exporter.")
-            self.rcon_enabled = False
-            # this will only run once due to return value of enable_rcon()
-            schedule.every(1).hours.do(self.enable_rcon())
+
+class PaperMsptParser(RconParser):
+    """
+    Paper's "mspt", e.g.
+    "Server tick times (avg/min/max) from last 5s, 10s, 1m:
+    ◴ 1.2/0.5/3.4, 1.1/0.4/3.0, 1.3/0.4/5.0"
+    """
+
+    commands = ("mspt",)
+    windows_regex = re.compile(r"from last ([^:]+):")
+    values_regex = re.compile(r"([\d.]+)/([\d.]+)/([\d.]+)")
+
+    def parse(self, command, output):
+        output = FORMATTING_REGEX.sub("", output)
+        match = self.windows_regex.search(output)
+        if not match:
             return []
 
-        # TODO come back here and make a metric out of online / max players
-        player_regex = re.compile("players online:(.*)")
-        if player_regex.findall(resp):
-            for player in player_regex.findall(resp)[0].split(","):
-                if not player.isspace():
-                    player_online.add_metric([player.lstrip()], 1)
+        result = []
+        windows = [window.strip() for window in match[1].split(",")]
+        values = self.values_regex.findall(output[match.end():])
+        for window, (avg, minimum, maximum) in zip(windows, values):
+            for stat, value in (("mean", avg), ("min", minimum),
+                                ("max", maximum)):
+                result.append(('minecraft_mspt_milliseconds',
+                               ("overall", window, stat), float(value)))
+        return result
 
-        return metrics
 
-    def get_player_advancements(self, uuid, name):
+class TickQueryParser(RconParser):
+    """
+    Vanilla's "tick query" (1.20.3+), e.g.
+    "Target tick rate: 20.0 per second. Average time per tick: 0.8ms
+    (Target: 50.0ms) Percentiles: P50: 0.7ms P95: 1.2ms P99: 1.6ms,
+    sample: 100"
+    """
+
+    commands = ("tick query",)
+    rate_regex = re.compile(r"Target tick rate: ([\d.]+)")
+    average_regex = re.compile(r"Average time per tick: ([\d.]+)ms")
+    percentile_regex = re.compile(r"P(\d+): ([\d.]+)ms")
+
+    def parse(self, command, output):
         result = []
-        logger.debug("Getting advancements for %s / %s." % (uuid, name))
-
-        data_version_metric = CounterMetricFamily(
-            'minecraft_advancement_data_version',
-            "The data version of the advancements file",
-            labels=['player'])
-        # aka minecraft
-        story_metric = CounterMetricFamily(
-            'minecraft_advancement_story_count',
-            "The count of completed story advancements.",
-            labels=['player'])
-        nether_metric = CounterMetricFamily(
-            'minecraft_advancement_nether_count',
-            "The count of completed nether advancements.",
-            labels=['player'])
-        end_metric = CounterMetricFamily(
-            'minecraft_advancement_end_count',
-            "The count of completed end advancements.",
-            labels=['player'])
-        adventure_metric = CounterMetricFamily(
-            'minecraft_advancement_adventure_count',
-            "The count of completed adventure advancements.",
-            labels=['player'])
-        husbandry_metric = CounterMetricFamily(
-            'minecraft_advancement_husbandry_count',
-            "The count of completed husbandry advancements.",
-            labels=['player'])
-        recipe_metric = CounterMetricFamily(
-            'minecraft_advancement_recipe_count',
-            "The count of completed recipe advancements.",
-            labels=['player'])
-        other_metric = CounterMetricFamily(
-            'minecraft_advancement_other_count',
-            "The count of completed other advancements.",
-            labels=['player'])
-
-        advancements_file_path = os.path.join(
-            self.advancements_directory, uuid + ".json")
-
-        if not isfile(advancements_file_path):
-            self.logger.warning("No advancements for player %s." % uuid)
+        match = self.rate_regex.search(output)
+        if match:
+            result.append(('minecraft_tick_rate_target', (), float(match[1])))
+
+        match = self.average_regex.search(output)
+        if match:
+            result.append(('minecraft_mspt_milliseconds',
+                           ("overall", "sample", "mean"), float(match[1])))
+
+        for percentile, value in self.percentile_regex.findall(output):
+            result.append(('minecraft_mspt_milliseconds',
+                           ("overall", "sample", "p" + percentile),
+                           float(value)))
+        return result
+
+
+class EntityCountParser(RconParser):
+    """
+    Counts the loaded entities of each dimension in RCON_DIMENSIONS with
+    a vanilla selector, e.g. "Test passed, count: 123"
+    """
+
+    command_format = \
+        "execute in %s positioned 0 0 0 if entity @e[distance=0..]"
+    count_regex = re.compile(r"count: (\d+)")
+
+    def __init__(self):
+        self.dimensions = dict()
+        for dimension in os.environ.get(
+                "RCON_DIMENSIONS", ",".join([
+                    MC_DIMENSION_OVERWORLD, MC_DIMENSION_NETHER,
+                    MC_DIMENSION_THE_END])).split(","):
+            self.dimensions[self.command_format % dimension] = dimension
+        self.commands = tuple(self.dimensions)
+
+    def parse(self, command, output):
+        match = self.count_regex.search(output)
+        if match:
+            count = int(match[1])
+        elif "Test failed" in output:
+            count = 0
         else:
-            with open(advancements_file_path) as json_file:
-                data_version = 0
-                story_count = 0
-                nether_count = 0
-                the_end_count = 0
-                adventure_count = 0
-                husbandry_count = 0
-                recipe_count = 0
-                unknown_count = 0
-
-                advancements = json.load(json_file)
-                for key, value in advancements.items():
-                    if key == "DataVersion":
-                        data_version = value
+            return []
+        return [('minecraft_entities_loaded',
+                 (self.dimensions[command],), count)]
+
+
+class PaperChunkInfoParser(RconParser):
+    """
+    Paper's "paper chunkinfo *", e.g. "Chunks in world: Total: 529
+    Inactive: 0 Border: 0 Ticking: 441 Entity: 441"
+    """
+
+    commands = ("paper chunkinfo *",)
+    world_regex = re.compile(
+        r"Chunks in (\S+?):\s*Total: (\d+)\s*Inactive: (\d+)\s*"
+        r"Border: (\d+)\s*Ticking: (\d+)")
+
+    def parse(self, command, output):
+        result = []
+        for match in self.world_regex.finditer(
+                FORMATTING_REGEX.sub("", output)):
+            if match[1] == "all":
+                continue
+            result.append(('minecraft_chunks_loaded',
+                           (match[1],), int(match[2])))
+            result.append(('minecraft_chunks_ticking',
+                           (match[1],), int(match[5])))
+        return result
+
+
+RCON_PARSERS = {
+    "list": ListParser,
+    "forge_tps": ForgeTpsParser,
+    "paper_tps": PaperTpsParser,
+    "paper_mspt": PaperMsptParser,
+    "tick_query": TickQueryParser,
+    "entities": EntityCountParser,
+    "paper_chunks": PaperChunkInfoParser,
+}
+
+
+class RconPoller(object):
+    """
+    Runs the commands of the configured RCON parsers every interval in a
+    background thread and keeps the latest samples for the scrapes.
+    """
+
+    def __init__(self, rcon, parsers, interval=15.0):
+        self.logger = logging.getLogger(__name__)
+        self.rcon = rcon
+        self.parsers = parsers
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (parser, command) -> samples of the last successful run
+        self.samples = dict()
+        self.poll_durations = Histogram(
+            'minecraft_exporter_rcon_poll_duration_seconds',
+            "Seconds it took to run the commands of all RCON parsers.",
+            registry=None)
+        self.thread = None
+
+    @classmethod
+    def from_env(cls, rcon):
+        parsers = []
+        for name in os.environ.get("RCON_PARSERS", "list").split(","):
+            name = name.strip()
+            if name not in RCON_PARSERS:
+                m_logger.error("Unknown RCON parser %s." % name)
+                continue
+            parsers.append(RCON_PARSERS[name]())
+        return cls(rcon, parsers,
+                   float(os.environ.get("RCON_POLL_INTERVAL", 15.0)))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="rcon-poller", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def poll(self):
+        start = time.time()
+        for parser in self.parsers:
+            for command in parser.commands:
+                try:
+                    samples = parser.parse(command, self.rcon.command(command))
+                except RconError as e:
+                    # Don't keep serving e.g. players of a stopped server
+                    self.logger.debug(e)
+                    samples = []
+                except Exception:
+                    self.logger.exception(
+                        "Polling RCON command %s failed." % command)
+                    samples = []
+                with self.lock:
+                    self.samples[(parser, command)] = samples
+        self.poll_durations.observe(time.time() - start)
+
+    def get_metrics(self):
+        return self.poll_durations.collect()
+
+    def get_samples(self):
+        with self.lock:
+            return [sample for samples in self.samples.values()
+                    for sample in samples]
+
+
+# Metrics produced by the RegionCollector
+WORLD_METRICS = {
+    'minecraft_world_region_files': (
+        GaugeMetricFamily,
+        "The number of region files of a dimension, by kind (region for"
+        " the chunks, entities for the entities since 1.17).",
+        ['dimension', 'kind']),
+    'minecraft_world_region_size_bytes': (
+        GaugeMetricFamily,
+        "The size of the region files of a dimension, by kind (region for"
+        " the chunks, entities for the entities since 1.17).",
+        ['dimension', 'kind']),
+    'minecraft_world_chunks': (
+        GaugeMetricFamily,
+        "The number of chunks saved in a dimension.",
+        ['dimension']),
+    'minecraft_world_entities': (
+        GaugeMetricFamily,
+        "The number of entities saved in a dimension.",
+        ['dimension']),
+    'minecraft_world_block_entities': (
+        GaugeMetricFamily,
+        "The number of block entities (tile entities) saved in a dimension.",
+        ['dimension']),
+    'minecraft_world_chunk_entities': (
+        GaugeMetricFamily,
+        "The number of entities saved in a chunk,"
+        " for the chunks with the most entities.",
+        ['dimension', 'x', 'z']),
+    'minecraft_world_chunk_block_entities': (
+        GaugeMetricFamily,
+        "The number of block entities saved in a chunk,"
+        " for the chunks with the most block entities.",
+        ['dimension', 'x', 'z']),
+}
+
+REGION_FILE_REGEX = re.compile(r"^r\.(-?\d+)\.(-?\d+)\.mca$")
+
+
+def read_region_chunk(region, index, directory, chunk_x, chunk_z):
+    """
+    Reads and decompresses one chunk of an Anvil region file.
+    :param region: The region file contents, e.g. an mmap
+    :return: The uncompressed NBT data or None if the chunk can't be read
+    """
+    location = int.from_bytes(region[index * 4:index * 4 + 3], "big")
+    offset = location * 4096
+    if offset + 5 > len(region):
+        return None
+
+    length, compression = struct.unpack(">iB", region[offset:offset + 5])
+    if compression & 128:
+        # Oversized chunks are stored in a separate file
+        compression &= 127
+        chunk_path = os.path.join(
+            directory, "c.%i.%i.mcc" % (chunk_x, chunk_z))
+        if not isfile(chunk_path):
+            return None
+        with open(chunk_path, "rb") as chunk_file:
+            data = chunk_file.read()
+    else:
+        data = region[offset + 5:offset + 4 + length]
+
+    if compression == 1:
+        return gzip.decompress(data)
+    elif compression == 2:
+        return zlib.decompress(data)
+    elif compression == 3:
+        return bytes(data)
+    # LZ4 (4) and custom compression are not supported
+    return None
+
+
+# Before 1.18 everything was nested in Level, since 1.17 entities are
+# saved in entities/ and since 1.18 block entities are at the top level
+CHUNK_ENTITY_TAGS = {
+    "Level": {"Entities": NBT_LENGTH, "TileEntities": NBT_LENGTH},
+    "Entities": NBT_LENGTH,
+    "block_entities": NBT_LENGTH,
+}
+
+
+def count_chunk_entities(data):
+    """
+    :param data: The uncompressed NBT data of a chunk
+    :return: (entities, block entities) saved in the chunk
+    """
+    chunk = read_nbt_tags(data, CHUNK_ENTITY_TAGS)
+    level = chunk.get("Level", chunk)
+    entities = level.get("Entities") or 0
+    block_entities = level.get("block_entities") or \
+        level.get("TileEntities") or 0
+    return entities, block_entities
+
+
+class RegionCollector(object):
+    """
+    Scans the Anvil region files of the world for chunk, entity and block
+    entity counts in a background thread.
+
+    Region files whose mtime and size did not change are not read again,
+    within a changed region file only chunks with a new timestamp in the
+    header are decompressed. Entities are counted from region/ (before
+    1.17) and entities/ (1.17+).
+    """
+
+    DIMENSIONS = (
+        (MC_DIMENSION_OVERWORLD, ""),
+        (MC_DIMENSION_NETHER, "DIM-1"),
+        (MC_DIMENSION_THE_END, "DIM1"),
+    )
+
+    def __init__(self, world_directory, interval=300.0, top_chunks=10):
+        self.logger = logging.getLogger(__name__)
+        self.world_directory = world_directory
+        self.interval = interval
+        self.top_chunks = top_chunks
+        self.lock = threading.Lock()
+        # path -> ((mtime_ns, size), {chunk index: (timestamp, counts)})
+        self.regions = dict()
+        self.samples = []
+        self.thread = None
+
+    @classmethod
+    def from_env(cls, world_directory):
+        """
+        :return: A collector if REGION_SCAN_INTERVAL is set, else None
+        """
+        interval = float(os.environ.get("REGION_SCAN_INTERVAL", 0))
+        if interval <= 0:
+            return None
+        return cls(world_directory, interval,
+                   int(os.environ.get("REGION_TOP_CHUNKS", 10)))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="region-scanner", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            start = time.time()
+            # noinspection PyBroadException
+            try:
+                self.scan()
+            except Exception:
+                self.logger.exception("Scanning region files failed.")
+            self.logger.debug(
+                "Scanned region files in %.3fs." % (time.time() - start))
+            time.sleep(self.interval)
+
+    def scan(self):
+        samples = []
+        seen = set()
+        for dimension, subdirectory in self.DIMENSIONS:
+            dimension_directory = os.path.join(
+                self.world_directory, subdirectory)
+            chunks = 0
+            # (chunk x, chunk z) -> [entities, block entities]
+            chunk_counts = defaultdict(lambda: [0, 0])
+
+            for kind in ("region", "entities"):
+                region_files = 0
+                region_size = 0
+                directory = os.path.join(dimension_directory, kind)
+                file_names = sorted(listdir(directory)) \
+                    if isdir(directory) else []
+
+                for file_name in file_names:
+                    match = REGION_FILE_REGEX.match(file_name)
+                    if not match:
+                        continue
+                    path = os.path.join(directory, file_name)
+                    try:
+                        size, region_chunks = self.scan_region_file(path)
+                    except OSError as e:
+                        self.logger.warning(
+                            "Reading region file %s failed: %s" % (path, e))
+                        continue
+                    seen.add(path)
+
+                    region_files += 1
+                    region_size += size
+                    if kind == "region":
+                        chunks += len(region_chunks)
+
+                    region_x = int(match[1]) * 32
+                    region_z = int(match[2]) * 32
+                    for index, (_, counts) in region_chunks.items():
+                        chunk = chunk_counts[(region_x + index % 32,
+                                              region_z + index // 32)]
+                        chunk[0] += counts[0]
+                        chunk[1] += counts[1]
+
+                samples.append(('minecraft_world_region_files',
+                                (dimension, kind), region_files))
+                samples.append(('minecraft_world_region_size_bytes',
+                                (dimension, kind), region_size))
+
+            samples.append(('minecraft_world_chunks', (dimension,), chunks))
+            samples.append(('minecraft_world_entities', (dimension,),
+                            sum(c[0] for c in chunk_counts.values())))
+            samples.append(('minecraft_world_block_entities', (dimension,),
+                            sum(c[1] for c in chunk_counts.values())))
+
+            for metric, column in (('minecraft_world_chunk_entities', 0),
+                                   ('minecraft_world_chunk_block_entities',
+                                    1)):
+                top = heapq.nlargest(
+                    self.top_chunks, chunk_counts.items(),
+                    key=lambda item: item[1][column])
+                for (x, z), counts in top:
+                    if counts[column] > 0:
+                        samples.append((metric, (dimension, str(x), str(z)),
+                                        counts[column]))
+
+        for path in set(self.regions) - seen:
+            del self.regions[path]
+
+        with self.lock:
+            self.samples = samples
+
+    def scan_region_file(self, path):
+        """
+        :return: (file size, {chunk index: (timestamp, counts)})
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.regions.get(path)
+        if cached is not None and cached[0] == key:
+            return stat.st_size, cached[1]
+
+        previous = cached[1] if cached is not None else dict()
+        region_chunks = dict()
+        if stat.st_size >= 8192:
+            match = REGION_FILE_REGEX.match(os.path.basename(path))
+            region_x = int(match[1]) * 32
+            region_z = int(match[2]) * 32
+            with open(path, "rb") as region_file, \
+                    mmap.mmap(region_file.fileno(), 0,
+                              access=mmap.ACCESS_READ) as region:
+                for index in range(1024):
+                    if region[index * 4:index * 4 + 4] == b"\0\0\0\0":
+                        continue
+                    timestamp, = struct.unpack(
+                        ">I", region[4096 + index * 4:4100 + index * 4])
+                    entry = previous.get(index)
+                    if entry is not None and entry[0] == timestamp:
+                        region_chunks[index] = entry
                         continue
+                    region_chunks[index] = (timestamp, self.count_chunk(
+                        region, index, path,
+                        region_x + index % 32, region_z + index // 32))
 
-                    if "story" in key and value.get("done", False) is True:
-                        story_count += 1
-                    elif "nether" in key and value.get("done", False) is True:
-                        nether_count += 1
-                    elif "end" in key and value.get("done", False) is True:
-                        the_end_count += 1
-                    elif "adventure" in key and value.get("done", False) is True:
-                        adventure_count += 1
-                    elif "husbandry" in key and value.get("done", False) is True:
-                        husbandry_count += 1
-                    elif "recipe" in key and value.get("done", False) is True:
-                        recipe_count += 1
-                    else:
-                        if value["done"] is True:
-                            unknown_count += 1
+        self.regions[path] = (key, region_chunks)
+        return stat.st_size, region_chunks
 
-            data_version_metric.add_metric([name], data_version)
-            result.append(data_version_metric)
+    def count_chunk(self, region, index, path, chunk_x, chunk_z):
+        # noinspection PyBroadException
+        try:
+            data = read_region_chunk(
+                region, index, os.path.dirname(path), chunk_x, chunk_z)
+            if data is None:
+                return 0, 0
+            return count_chunk_entities(data)
+        except Exception:
+            self.logger.debug("Reading chunk %i,%i of %s failed." % (
+                chunk_x, chunk_z, path), exc_info=True)
+            return 0, 0
 
-            story_metric.add_metric([name], story_count)
-            result.append(story_metric)
+    def collect(self):
+        with self.lock:
+            samples = self.samples
+        return build_metric_families(samples, WORLD_METRICS)
+
+
+# Metrics produced by the LevelCollector
+LEVEL_METRICS = {
+    'minecraft_world_info': (
+        GaugeMetricFamily,
+        "Always 1, the name and Minecraft version of the world in labels.",
+        ['level_name', 'version']),
+    'minecraft_world_data_version': (
+        GaugeMetricFamily,
+        "The data version the world was saved with.",
+        []),
+    'minecraft_world_game_time_ticks': (
+        CounterMetricFamily,
+        "The number of ticks the world has run.",
+        []),
+    'minecraft_world_days': (
+        GaugeMetricFamily,
+        "The number of the current in-game day.",
+        []),
+    'minecraft_world_time_of_day_ticks': (
+        GaugeMetricFamily,
+        "The time of day in ticks, 0 is sunrise, 6000 noon and 18000"
+        " midnight.",
+        []),
+    'minecraft_world_raining': (
+        GaugeMetricFamily,
+        "The value is 1 if it is raining, 0 if not.",
+        []),
+    'minecraft_world_thundering': (
+        GaugeMetricFamily,
+        "The value is 1 if there is a thunderstorm, 0 if not.",
+        []),
+    'minecraft_world_border_size_blocks': (
+        GaugeMetricFamily,
+        "The diameter of the world border.",
+        []),
+    'minecraft_world_border_center': (
+        GaugeMetricFamily,
+        "The center of the world border.",
+        ['axis']),
+}
+
+# Only these tags are decoded, the rest of level.dat (e.g. the player of
+# a singleplayer world) is skipped
+LEVEL_TAGS = {
+    "Data": {
+        "LevelName": True,
+        "Version": {"Name": True},
+        "DataVersion": True,
+        "Time": True,
+        "DayTime": True,
+        "raining": True,
+        "thundering": True,
+        "BorderSize": True,
+        "BorderCenterX": True,
+        "BorderCenterZ": True,
+    },
+}
+
+# Metrics produced by the ScoreboardCollector
+SCOREBOARD_METRICS = {
+    'minecraft_scoreboard_objectives': (
+        GaugeMetricFamily,
+        "The number of scoreboard objectives.",
+        []),
+    'minecraft_scoreboard_score': (
+        GaugeMetricFamily,
+        "The score of a player (or other score holder) in an objective.",
+        ['objective', 'criteria', 'player']),
+    'minecraft_scoreboard_team_members': (
+        GaugeMetricFamily,
+        "The number of members of a team.",
+        ['team']),
+}
+
+# The display slots are skipped. Selecting tags within the items of the
+# lists is no faster than decoding them, the skipped tags are tiny.
+SCOREBOARD_TAGS = {
+    "data": {"Objectives": True, "PlayerScores": True, "Teams": True},
+}
+
+
+class NbtFileCollector(object):
+    """
+    Exports the samples read from one NBT file, which is only read again
+    when its mtime or size changed. Failed reads keep the previous samples
+    until the file changes again.
+    """
+
+    name = None
+    metrics = None
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.key = None
+        self.samples = []
+        self.reads = 0
 
-            nether_metric.add_metric([name], nether_count)
-            result.append(nether_metric)
+    def read(self):
+        """
+        :return: The samples of the file
+        """
+        raise NotImplementedError()
 
-            end_metric.add_metric([name], the_end_count)
-            result.append(end_metric)
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.key = None
+            self.samples = []
+            return
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key == self.key:
+            return
+        self.key = key
+        self.reads += 1
+        # noinspection PyBroadException
+        try:
+            self.samples = self.read()
+        except Exception:
+            self.logger.warning("Reading %s failed." % self.path,
+                                exc_info=True)
 
-            adventure_metric.add_metric([name], adventure_count)
-            result.append(adventure_metric)
+    def collect(self):
+        with self.lock:
+            self.refresh()
+            samples = self.samples
+        return build_metric_families(samples, self.metrics)
 
-            husbandry_metric.add_metric([name], husbandry_count)
-            result.append(husbandry_metric)
 
-            recipe_metric.add_metric([name], recipe_count)
-            result.append(recipe_metric)
+class LevelCollector(NbtFileCollector):
+    """
+    Exports the game time, weather and world border from level.dat.
+    """
 
-            other_metric.add_metric([name], unknown_count)
-            result.append(other_metric)
+    name = "level.dat"
+    metrics = LEVEL_METRICS
 
-        return result
+    @classmethod
+    def from_env(cls, world_directory):
+        """
+        :return: A collector if LEVEL_METRICS=true, else None
+        """
+        if os.environ.get("LEVEL_METRICS", "false") != "true":
+            return None
+        return cls(os.path.join(world_directory, "level.dat"))
+
+    def read(self):
+        level = read_nbt_file(self.path, LEVEL_TAGS).get("Data", {})
+        samples = [('minecraft_world_info', (
+            level.get("LevelName", ""),
+            level.get("Version", {}).get("Name", "")), 1)]
+        if "DataVersion" in level:
+            samples.append(('minecraft_world_data_version', (),
+                            level["DataVersion"]))
+        if "Time" in level:
+            samples.append(('minecraft_world_game_time_ticks', (),
+                            level["Time"]))
+        if "DayTime" in level:
+            days, time_of_day = divmod(level["DayTime"], 24000)
+            samples.append(('minecraft_world_days', (), days))
+            samples.append(('minecraft_world_time_of_day_ticks', (),
+                            time_of_day))
+        for tag, metric in (("raining", 'minecraft_world_raining'),
+                            ("thundering", 'minecraft_world_thundering')):
+            if tag in level:
+                samples.append((metric, (), level[tag]))
+        if "BorderSize" in level:
+            samples.append(('minecraft_world_border_size_blocks', (),
+                            level["BorderSize"]))
+        for tag, axis in (("BorderCenterX", "x"), ("BorderCenterZ", "z")):
+            if tag in level:
+                samples.append(('minecraft_world_border_center', (axis,),
+                                level[tag]))
+        return samples
+
+
+class ScoreboardCollector(NbtFileCollector):
+    """
+    Exports the objectives, scores and teams from data/scoreboard.dat.
+    Only the scores of the objectives matching SCOREBOARD_OBJECTIVES are
+    exported, as minigames may keep scores for thousands of entities.
+    """
+
+    name = "scoreboard.dat"
+    metrics = SCOREBOARD_METRICS
+
+    def __init__(self, path, objectives=None):
+        """
+        :param objectives: The objectives to export the scores of, see
+        compile_patterns, or None for all
+        """
+        super().__init__(path)
+        self.objectives = compile_patterns(objectives)
 
-    def get_player_data(self, uuid, name):
-        result = []
-        logger.debug("Getting player data for %s / %s." % (uuid, name))
-
-        #  TODO double check that score resets on death in server
-        minecraft_score = GaugeMetricFamily(
-            'minecraft_score',
-            "The score of a player.", labels=['player'])
-        # This is still a gauge because it can reset on death vs server
-        minecraft_xp_total = GaugeMetricFamily(
-            'minecraft_xp_total',
-            "The total amount of XP the player has collected over time;"
-            " used for the Score upon death.", labels=['player'])
-        minecraft_current_level = GaugeMetricFamily(
-            'minecraft_current_level',
-            "The level shown on the XP bar.",
-            labels=['player'])
-        minecraft_health = GaugeMetricFamily(
-            'minecraft_health',
-            "How much Health the player currently has",
-            labels=['player'])
-        minecraft_food_level = GaugeMetricFamily(
-            'minecraft_food_level',
-            "The value of the hunger bar; 20 is full.",
-            labels=['player'])
-        minecraft_food_saturation_level = GaugeMetricFamily(
-            'minecraft_food_saturation_level',
-            "The food saturation the player currently has.",
-            labels=['player'])
-        minecraft_food_exhaustion_level = GaugeMetricFamily(
-            'minecraft_food_exhaustion_level',
-            "The food exhaustion the player currently has.",
-            labels=['player'])
-        minecraft_game_type = GaugeMetricFamily(
-            'minecraft_game_type',
-            "The game mode of the player."
-            " 0 is Survival, 1 is Creative,"
-            " 2 is Adventure and 3 is Spectator.",
-            labels=['player'])
-        minecraft_dimension = GaugeMetricFamily(
-            'minecraft_dimension',
-            "A namespaced ID of the dimension the player is in.",
-            labels=['player', 'dimension'])
-
-        player_data_file_path = os.path.join(
-            self.player_directory, uuid + ".dat")
-
-        if not isfile(player_data_file_path):
-            self.logger.error("No player data for player %s." % uuid)
+    @classmethod
+    def from_env(cls, world_directory):
+        """
+        :return: A collector if SCOREBOARD_METRICS=true, else None
+        """
+        if os.environ.get("SCOREBOARD_METRICS", "false") != "true":
+            return None
+        objectives = [pattern.strip() for pattern in os.environ.get(
+            "SCOREBOARD_OBJECTIVES", "").split(",") if pattern.strip()]
+        return cls(os.path.join(world_directory, "data", "scoreboard.dat"),
+                   objectives)
+
+    def read(self):
+        scoreboard = read_nbt_file(self.path, SCOREBOARD_TAGS).get("data", {})
+        criteria = dict(
+            (objective.get("Name"), objective.get("CriteriaName", ""))
+            for objective in scoreboard.get("Objectives", []))
+        samples = [('minecraft_scoreboard_objectives', (), len(criteria))]
+        for score in scoreboard.get("PlayerScores", []):
+            objective = score.get("Objective")
+            if objective not in criteria:
+                continue
+            if self.objectives is not None and \
+                    not self.objectives.match(objective):
+                continue
+            samples.append(('minecraft_scoreboard_score', (
+                objective, criteria[objective], score.get("Name", "")),
+                score.get("Score", 0)))
+        for team in scoreboard.get("Teams", []):
+            samples.append(('minecraft_scoreboard_team_members',
+                            (team.get("Name", ""),),
+                            len(team.get("Players", []))))
+        return samples
+
+
+# Metrics produced by the LogTailer
+LOG_METRICS = {
+    'minecraft_log_joins': (
+        CounterMetricFamily,
+        "The number of times a player joined, from the server log.",
+        []),
+    'minecraft_log_leaves': (
+        CounterMetricFamily,
+        "The number of times a player left, from the server log.",
+        []),
+    'minecraft_log_deaths': (
+        CounterMetricFamily,
+        "The number of player deaths by cause, from the server log.",
+        ['cause']),
+    'minecraft_log_chat_messages': (
+        CounterMetricFamily,
+        "The number of chat messages, from the server log.",
+        []),
+    'minecraft_log_lag_warnings': (
+        CounterMetricFamily,
+        "The number of \"Can't keep up!\" warnings in the server log.",
+        []),
+    'minecraft_log_lag_milliseconds': (
+        CounterMetricFamily,
+        "The milliseconds the server fell behind by in \"Can't keep up!\""
+        " warnings.",
+        []),
+    'minecraft_log_skipped_ticks': (
+        CounterMetricFamily,
+        "The ticks skipped by the server in \"Can't keep up!\" warnings.",
+        []),
+    'minecraft_log_players_online': (
+        GaugeMetricFamily,
+        "The number of players online according to the server log.",
+        []),
+    'minecraft_log_player_online': (
+        GaugeMetricFamily,
+        "The value is 1 if the player is online according to the server"
+        " log, missing if not.",
+        ['player']),
+    'minecraft_exporter_log_read_bytes': (
+        CounterMetricFamily,
+        "The number of bytes read from the server log.",
+        []),
+    'minecraft_exporter_log_rotations': (
+        CounterMetricFamily,
+        "The number of times the server log was rotated or truncated.",
+        []),
+}
+
+# The message of a log line follows the first "]: ", e.g. after
+# "[12:00:00] [Server thread/INFO]: " (vanilla) or "[12:00:00 INFO]: "
+# (Paper). The outermost group that matched names the kind of line.
+LOG_MESSAGE_REGEX = re.compile(
+    r"(?P<join>(?P<join_player>\S+) joined the game$)"
+    r"|(?P<leave>(?P<leave_player>\S+) left the game$)"
+    r"|(?P<chat>(?:\[Not Secure\] )?<[^>]+> )"
+    r"|(?P<lag>Can't keep up! Is the server overloaded\? "
+    r"Running (?P<lag_milliseconds>\d+)ms or (?P<lag_ticks>\d+) ticks"
+    r" behind)"
+    r"|(?P<start>Starting minecraft server version )"
+    r"|(?P<stop>Stopping server$)")
+# cause -> the beginning of the vanilla death messages, more specific
+# messages first
+LOG_DEATH_CAUSES = (
+    ("void", r"fell out of the world|left the confines of this world"
+             r"|didn't want to live in the same world as"),
+    ("crushed", r"was squashed by a falling"
+                r"|was skewered by a falling stalactite"),
+    ("fall", r"fell |hit the ground too hard|was doomed to fall"
+             r"|was impaled on a stalagmite|experienced kinetic energy"),
+    ("drowning", r"drowned"),
+    ("lava", r"tried to swim in lava|discovered the floor was lava"),
+    ("fire", r"burned to death|went up in flames|walked into fire"
+             r"|was burnt to a crisp|walked into the danger zone"),
+    ("explosion", r"blew up|was blown up by"
+                  r"|was killed by \[Intentional Game Design\]"),
+    ("magic", r"was killed by (?:even more )?magic"),
+    ("starvation", r"starved to death"),
+    ("suffocation", r"suffocated in a wall|was squished too much"
+                    r"|was squashed by"),
+    ("freezing", r"froze to death|was frozen to death"),
+    ("lightning", r"was struck by lightning"),
+    ("wither", r"withered away"),
+    ("cactus", r"was pricked to death|walked into a cactus"
+               r"|was poked to death by a sweet berry bush"),
+    ("shot", r"was shot by|was fireballed by|was struck by a fireball"),
+    ("slain", r"was slain by|was finished off by|was killed by"
+              r"|was stung to death|was impaled by|was obliterated by"
+              r"|was pummeled by|was speared by"),
+    ("other", r"died$|was killed$"),
+)
+LOG_DEATH_REGEX = re.compile(r"(?P<player>\S+) (?:%s)" % "|".join(
+    "(?P<%s>%s)" % cause for cause in LOG_DEATH_CAUSES))
+
+
+class LogTailer(object):
+    """
+    Follows the server's logs/latest.log in a background thread and counts
+    joins, leaves, deaths, chat messages and lag warnings, and keeps track
+    of who is online, without any RCON commands.
+
+    The position in the log and the players online are persisted to a
+    state file (if given), so a restart neither counts lines again nor
+    loses who is online. When the server rotates the log, the rest of the
+    old file is read before following the new one.
+    """
+
+    # Seconds between writes of the state file
+    SAVE_INTERVAL = 10.0
+
+    def __init__(self, path, interval=1.0, state_file=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.interval = interval
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        # an incomplete last line
+        self.buffer = b""
+        self.online = set()
+        self.counts = dict((metric, 0) for metric in (
+            'minecraft_log_joins', 'minecraft_log_leaves',
+            'minecraft_log_chat_messages', 'minecraft_log_lag_warnings',
+            'minecraft_log_lag_milliseconds', 'minecraft_log_skipped_ticks'))
+        self.deaths = defaultdict(int)
+        self.read_bytes = 0
+        self.rotations = 0
+        self.saved_at = 0.0
+        self.saved_position = None
+        self.thread = None
+
+    @classmethod
+    def from_env(cls, world_directory, path=None, state_file=None):
+        """
+        :param path: The log file, by default logs/latest.log next to the
+        world directory
+        :return: A tailer if LOG_TAIL_INTERVAL is set, else None
+        """
+        interval = float(os.environ.get("LOG_TAIL_INTERVAL", 0))
+        if interval <= 0:
+            return None
+        if path is None:
+            path = os.path.join(
+                os.path.dirname(world_directory.rstrip("/")),
+                "logs", "latest.log")
+        return cls(path, interval, state_file)
+
+    def start(self):
+        if self.thread is None:
+            self.load()
+            self.thread = threading.Thread(
+                target=self.run, name="log-tailer", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            # noinspection PyBroadException
+            try:
+                self.poll()
+            except Exception:
+                self.logger.exception("Reading %s failed." % self.path)
+                self.close()
+            time.sleep(self.interval)
+
+    def load(self):
+        if not self.state_file or not isfile(self.state_file):
+            return
+
+        # noinspection PyBroadException
+        try:
+            with open(self.state_file) as json_file:
+                state = json.load(json_file)
+            self.inode = state["inode"]
+            self.offset = state["offset"]
+            self.online = set(state["online"])
+        except Exception:
+            self.logger.exception(
+                "Loading log state %s failed." % self.state_file)
+
+    def save(self):
+        position = (self.inode, self.offset - len(self.buffer))
+        if not self.state_file or position == self.saved_position or \
+                time.time() < self.saved_at + self.SAVE_INTERVAL:
+            return
+
+        with self.lock:
+            data = json.dumps({"inode": position[0], "offset": position[1],
+                               "online": sorted(self.online)})
+        temp_file = self.state_file + ".tmp"
+        # noinspection PyBroadException
+        try:
+            with open(temp_file, "w") as json_file:
+                json_file.write(data)
+            os.replace(temp_file, self.state_file)
+            self.saved_position = position
+            self.saved_at = time.time()
+        except Exception:
+            self.logger.exception(
+                "Saving log state %s failed." % self.state_file)
+
+    def open(self):
+        """
+        Opens the log, at the persisted offset if it is the same file.
+        """
+        try:
+            self.file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        stat = os.fstat(self.file.fileno())
+        if stat.st_ino == self.inode and self.offset <= stat.st_size:
+            self.file.seek(self.offset)
         else:
-            nbtfile = nbt.nbt.NBTFile(player_data_file_path, 'rb')
+            self.offset = 0
+        self.inode = stat.st_ino
+        self.buffer = b""
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def poll(self):
+        if self.file is None:
+            self.open()
+            if self.file is None:
+                return
+        self.read()
 
-            minecraft_score.add_metric([name], nbtfile.get("Score").value)
-            result.append(minecraft_score)
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Rotated, the new log is not there yet
+            return
+        if stat.st_ino != self.inode:
+            # Rotated, lines may have been added to the old file since
+            self.read()
+            self.close()
+            self.rotations += 1
+            self.inode = None
+            self.open()
+            self.read()
+        elif stat.st_size < self.offset:
+            # Truncated (copytruncate)
+            self.file.seek(0)
+            self.offset = 0
+            self.buffer = b""
+            self.rotations += 1
+            self.read()
+        self.save()
+
+    def read(self):
+        data = self.file.read()
+        if not data:
+            return
+        self.offset += len(data)
+        self.read_bytes += len(data)
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.parse_line(line.decode("utf-8", "replace"))
+
+    def parse_line(self, line):
+        # Caller holds self.lock
+        start = line.find("]: ")
+        if start < 0:
+            return
+        message = line[start + 3:].rstrip("\r")
+
+        match = LOG_MESSAGE_REGEX.match(message)
+        if match is None:
+            death = LOG_DEATH_REGEX.match(message)
+            # Only online players can die, this keeps out other messages
+            if death is not None and death.group("player") in self.online:
+                self.deaths[death.lastgroup] += 1
+            return
+
+        kind = match.lastgroup
+        if kind == "join":
+            self.counts['minecraft_log_joins'] += 1
+            self.online.add(match.group("join_player"))
+        elif kind == "leave":
+            self.counts['minecraft_log_leaves'] += 1
+            self.online.discard(match.group("leave_player"))
+        elif kind == "chat":
+            self.counts['minecraft_log_chat_messages'] += 1
+        elif kind == "lag":
+            self.counts['minecraft_log_lag_warnings'] += 1
+            self.counts['minecraft_log_lag_milliseconds'] += \
+                int(match.group("lag_milliseconds"))
+            self.counts['minecraft_log_skipped_ticks'] += \
+                int(match.group("lag_ticks"))
+        else:
+            # The server started or stopped, nobody is online
+            self.online.clear()
 
-            minecraft_xp_total.add_metric([name], nbtfile.get("XpTotal").value)
-            result.append(minecraft_xp_total)
+    def collect(self):
+        with self.lock:
+            samples = [(metric, (), value)
+                       for metric, value in self.counts.items()]
+            samples.extend(('minecraft_log_deaths', (cause,), value)
+                           for cause, value in self.deaths.items())
+            samples.append(
+                ('minecraft_log_players_online', (), len(self.online)))
+            samples.extend(('minecraft_log_player_online', (player,), 1)
+                           for player in sorted(self.online))
+        samples.append(('minecraft_exporter_log_read_bytes', (),
+                        self.read_bytes))
+        samples.append(('minecraft_exporter_log_rotations', (),
+                        self.rotations))
+        return build_metric_families(samples, LOG_METRICS)
+
+
+PLAYER_FILE_REGEX = re.compile(
+    r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+    r"\.(json|dat)$")
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class PlayerFileWatcher(object):
+    """
+    Keeps an index of the players and tells the parse cache which player
+    files the server saved, so scrapes neither list the directories nor
+    stat unchanged files.
+
+    Uses inotify where available, otherwise (or with WATCH_FILES=poll) the
+    directories are listed every poll_interval seconds in the background.
+    """
+
+    def __init__(self, stats_directory, directories, parse_cache,
+                 mode="inotify", poll_interval=5.0):
+        self.logger = logging.getLogger(__name__)
+        self.stats_directory = stats_directory
+        self.directories = directories
+        self.parse_cache = parse_cache
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.players = set()
+        # path -> (inode, mtime_ns, size), only used when polling
+        self.files = dict()
+        self.watches = dict()
+        self.inotify_fd = None
+        self.thread = None
+
+    def start(self):
+        if self.mode == "inotify":
+            self.inotify_fd = self.init_inotify()
+        if self.inotify_fd is None:
+            self.mode = "poll"
+        self.logger.info("Watching player files (%s)." % self.mode)
+
+        self.rescan()
+        self.parse_cache.trusted = True
+        self.thread = threading.Thread(
+            target=self.run, name="watcher", daemon=True)
+        self.thread.start()
+
+    def init_inotify(self):
+        # noinspection PyBroadException
+        try:
+            # The libc the interpreter is linked against, glibc or musl
+            # (alpine), where find_library("c") finds nothing
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            for directory in self.directories:
+                wd = libc.inotify_add_watch(
+                    fd, os.fsencode(directory),
+                    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "Watching %s failed" % directory)
+                self.watches[wd] = directory
+            return fd
+        except Exception as e:
+            self.logger.warning(
+                "inotify is not available (%s), polling instead." % e)
+            return None
 
-            minecraft_current_level.add_metric(
-                [name], nbtfile.get("XpLevel").value)
-            result.append(minecraft_current_level)
+    def run(self):
+        while True:
+            # noinspection PyBroadException
+            try:
+                if self.mode == "inotify":
+                    self.read_events()
+                else:
+                    time.sleep(self.poll_interval)
+                    self.rescan()
+            except Exception:
+                self.logger.exception("Watching player files failed.")
+                time.sleep(self.poll_interval)
+
+    def read_events(self):
+        data = os.read(self.inotify_fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b"\0").decode()
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("Missed inotify events, rescanning.")
+                self.rescan()
+            elif wd in self.watches:
+                self.changed(self.watches[wd], name,
+                             bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+
+    def changed(self, directory, name, exists):
+        match = PLAYER_FILE_REGEX.match(name)
+        if not match:
+            return
+        self.parse_cache.invalidate(os.path.join(directory, name))
+        if directory == self.stats_directory and match[2] == "json":
+            if exists:
+                self.players.add(match[1])
+            else:
+                self.players.discard(match[1])
 
-            minecraft_health.add_metric([name], nbtfile.get("Health").value)
-            result.append(minecraft_health)
+    def rescan(self):
+        """
+        Lists the directories, with inotify this is only done at startup
+        and when events were lost.
+        """
+        files = dict()
+        for directory in self.directories:
+            if not isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if PLAYER_FILE_REGEX.match(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (
+                        stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        for path in set(self.files) | set(files):
+            if self.inotify_fd is not None or \
+                    self.files.get(path) != files.get(path):
+                self.changed(os.path.dirname(path), os.path.basename(path),
+                             path in files)
+        self.files = files
 
-            minecraft_food_level.add_metric(
-                [name], nbtfile.get("foodLevel").value)
-            result.append(minecraft_food_level)
+    def get_players(self):
+        return sorted(self.players)
+
+
+def read_player_file(reader, path, name, metric_filter):
+    """
+    Runs a reader, possibly on a worker process, and times it.
+    :return: (samples, seconds, error message or None)
+    """
+    start = time.time()
+    # noinspection PyBroadException
+    try:
+        samples = reader(path, name, metric_filter)
+        error = None
+    except Exception as e:
+        samples = []
+        error = "%s: %s" % (type(e).__name__, e)
+    return samples, time.time() - start, error
+
+
+def create_executor():
+    """
+    Creates the worker pool used to parse player files.
+    COLLECT_POOL=thread suits slow disks, COLLECT_POOL=process spreads
+    the JSON and NBT decoding over several CPUs.
+    :return: An Executor or None if files are parsed sequentially
+    """
+    workers = int(os.environ.get("COLLECT_WORKERS", "1"))
+    if workers <= 1:
+        return None
+
+    pool = os.environ.get("COLLECT_POOL", "thread")
+    m_logger.info(
+        "Parsing player files with %i %s workers." % (workers, pool))
+    if pool == "process":
+        # The workers are started on the first scrape, when the RCON,
+        # name resolver and log threads already run. A forked child could
+        # inherit a lock one of them holds (e.g. of a logging handler).
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    return ThreadPoolExecutor(max_workers=workers)
 
-            minecraft_food_saturation_level.add_metric(
-                [name], nbtfile.get("foodSaturationLevel").value)
-            result.append(minecraft_food_saturation_level)
 
-            minecraft_food_exhaustion_level.add_metric(
-                [name], nbtfile.get("foodExhaustionLevel").value)
-            result.append(minecraft_food_exhaustion_level)
+class MinecraftCollector(object):
+    def __init__(self, world_directory, rcon=None, name_resolver=None,
+                 user_cache_file=None, executor=None, log_file=None,
+                 log_state_file=None):
+        """
+        :param world_directory: The world directory of the server
+        :param rcon: An RconClient, or None to collect without RCON
+        :param name_resolver: A NameResolver shared with other collectors,
+        by default one is created from the environment
+        :param user_cache_file: The usercache.json of the server, by
+        default the one next to the world directory
+        :param executor: The pool player files are parsed on, see
+        create_executor, or None to parse them sequentially
+        :param log_file: The log to follow with LOG_TAIL_INTERVAL, by
+        default logs/latest.log next to the world directory
+        :param log_state_file: Where to persist the position in the log
+        """
+        # Can move this around or add handlers as needed
+        self.logger = logging.getLogger(__name__)
 
-            minecraft_game_type.add_metric(
-                [name], nbtfile.get("playerGameType").value)
-            result.append(minecraft_game_type)
+        self.stats_directory = "%s/stats" % world_directory
+        self.player_directory = "%s/playerdata" % world_directory
+        self.advancements_directory = "%s/advancements" % world_directory
+        self.region_collector = RegionCollector.from_env(world_directory)
+        if self.region_collector is not None:
+            self.region_collector.start()
+        self.nbt_file_collectors = [
+            collector for collector in (
+                LevelCollector.from_env(world_directory),
+                ScoreboardCollector.from_env(world_directory))
+            if collector is not None]
+        self.log_tailer = LogTailer.from_env(
+            world_directory, log_file, log_state_file)
+        if self.log_tailer is not None:
+            self.log_tailer.start()
+        self.rcon = rcon
+        if self.rcon is not None:
+            self.rcon.start()
+            self.rcon_poller = RconPoller.from_env(self.rcon)
+            self.rcon_poller.start()
+        if user_cache_file is None:
+            user_cache_file = os.path.join(
+                os.path.dirname(world_directory.rstrip("/")),
+                "usercache.json")
+        self.user_cache = UserCache(user_cache_file)
+        # The metrics of a shared resolver are exported by its owner
+        self.shares_name_resolver = name_resolver is not None
+        if name_resolver is None:
+            name_resolver = NameResolver.from_env()
+        self.name_resolver = name_resolver
+        self.metric_filter = MetricFilter.from_env()
+        self.parse_cache = ParseCache()
+        self.executor = executor
+        self.phase_durations = Histogram(
+            'minecraft_exporter_phase_duration_seconds',
+            "Seconds spent per phase of collecting the player files. The"
+            " advancements, playerdata and stats phases are the time spent"
+            " parsing those files, summed up over the workers.",
+            ['phase'], registry=None)
+        self.parse_errors = defaultdict(int)
+        # (seconds, source, uuid) of the slowest file parsed this cycle
+        self.slowest_file = None
+        self.watcher = None
+        if os.environ.get("WATCH_FILES"):
+            self.watcher = PlayerFileWatcher(
+                self.stats_directory,
+                [self.stats_directory, self.advancements_directory,
+                 self.player_directory],
+                self.parse_cache, os.environ["WATCH_FILES"],
+                float(os.environ.get("WATCH_POLL_INTERVAL", 5.0)))
+            self.watcher.start()
+
+        # Players whose stats were not saved within the window are only
+        # read every inactive_refresh_interval seconds
+        self.active_window = \
+            float(os.environ.get("ACTIVE_PLAYER_DAYS", 0)) * 24 * 3600
+        self.inactive_mode = os.environ.get("INACTIVE_PLAYERS", "aggregate")
+        self.inactive_refresh_interval = \
+            float(os.environ.get("INACTIVE_REFRESH_INTERVAL", 3600))
+        self.inactive_players = set()
+        self.inactive_samples = []
+        self.inactive_refreshed_at = 0.0
+
+        # off, on or only (no per-player metrics)
+        self.aggregate_mode = os.environ.get("AGGREGATE_METRICS", "off")
+        self.aggregator = None
+        if self.aggregate_mode != "off":
+            self.aggregator = ServerAggregator()
+        self.completions = None
+        if ADVANCEMENT_COMPLETION_RATIO:
+            self.completions = ServerAggregator({
+                ADVANCEMENT_DONE: 'minecraft_advancement_completion_ratio'})
+        # Held for a whole collection cycle, see collect_players
+        self.collect_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        :return: A collector for WORLD_DIR and the RCON_* server
+        """
+        return cls(os.environ.get("WORLD_DIR", "/world"),
+                   RconClient.from_env(),
+                   user_cache_file=os.environ.get("USERCACHE_FILE"),
+                   executor=create_executor(),
+                   log_file=os.environ.get("LOG_FILE"),
+                   log_state_file=os.environ.get("LOG_TAIL_STATE_FILE"))
 
-            # Give a unique value (1-3) for each default dimension
-            # and 4 for anything custom. Makes it easier to graph.
-            dimension = nbtfile.get("Dimension").value
-            minecraft_dimension.add_metric(
-                [name, dimension], get_dimension_value(dimension))
-            result.append(minecraft_dimension)
+    def get_players(self):
+        if self.watcher is not None:
+            return self.watcher.get_players()
+        if not isdir(self.stats_directory):
+            self.logger.warning(
+                "No stats!"
+                "\nTry joining the server."
+                "\nHave you mounted the world into the container?"
+            )
+            return []
+        else:
+            return [f[:-5] for f in listdir(self.stats_directory) if isfile(join(self.stats_directory, f))]
+
+    def uuid_to_player(self, uuid):
+        name = self.user_cache.get(uuid)
+        if name is not None:
+            return name
+
+        name = self.name_resolver.get(uuid)
+        if name is None:
+            self.logger.debug("No username for %s yet, using UUID." % uuid)
+            return uuid
+        return name
+
+    def get_server_stats(self):
+        metrics = []
+        if self.log_tailer is not None:
+            metrics.extend(self.log_tailer.collect())
+
+        if self.rcon is None:
+            self.logger.warning(
+                "RCON_HOST and/or RCON_password are not defined."
+                "\nServer stats not available."
+            )
+            return metrics
+
+        metrics.extend(self.rcon.get_metrics())
+        metrics.extend(self.rcon_poller.get_metrics())
+        metrics.extend(build_metric_families(
+            self.rcon_poller.get_samples(), SERVER_METRICS))
+        return metrics
+
+    def player_file(self, source, uuid):
+        if source == "advancements":
+            return os.path.join(self.advancements_directory, uuid + ".json")
+        elif source == "playerdata":
+            return os.path.join(self.player_directory, uuid + ".dat")
+        else:
+            return os.path.join(self.stats_directory, uuid + ".json")
+
+    def get_player_advancements(self, uuid, name):
+        self.logger.debug("Getting advancements for %s / %s." % (uuid, name))
+
+        result = self.parse_cache.get(
+            "advancements", self.player_file("advancements", uuid),
+            read_player_advancements, name, self.metric_filter)
+        if result is None:
+            self.logger.warning("No advancements for player %s." % uuid)
+            return []
+
+        return result
+
+    def get_player_data(self, uuid, name):
+        self.logger.debug("Getting player data for %s / %s." % (uuid, name))
+
+        result = self.parse_cache.get(
+            "playerdata", self.player_file("playerdata", uuid),
+            read_player_data, name, self.metric_filter)
+        if result is None:
+            self.logger.error("No player data for player %s." % uuid)
+            return []
 
         return result
 
     def get_player_stats(self, uuid, name):
-        result = []
+        self.logger.debug("Getting player stats for %s / %s." % (uuid, name))
 
-        logger.debug("Getting player stats for %s / %s." % (uuid, name))
-        # Define a metric for each category of stat
-        # https://minecraft.fandom.com/wiki/Statistics#Statistic_types_and_names
-        blocks_mined = CounterMetricFamily(
-            'minecraft_blocks_mined_total',
-            'The count of blocks a player mined by block type.',
-            labels=['player', 'block'])
-        items_broken = CounterMetricFamily(
-            'minecraft_items_broken_total',
-            'The count of items a player has used to negative durability.',
-            labels=['player', 'item'])
-        items_crafted = CounterMetricFamily(
-            'minecraft_items_crafted_total',
-            'The count of items a player has crafted, smelted, etc.',
-            labels=['player', 'item'])
-        items_used = CounterMetricFamily(
-            'minecraft_items_used_total',
-            'The count of blocks or items a player used.',
-            labels=['player', 'item'])
-        items_picked_up = CounterMetricFamily(
-            'minecraft_items_picked_up_total',
-            'The count of items a player picked up.',
-            labels=['player', 'item'])
-        items_dropped = CounterMetricFamily(
-            'minecraft_items_dropped_total',
-            'The count of items a player has dropped.',
-            labels=['player', 'item'])
-        entities_killed = CounterMetricFamily(
-            'minecraft_entities_killed_total',
-            "The count of entities killed by a player.",
-            labels=['player', 'entity'])
-        entities_killed_by = CounterMetricFamily(
-            'minecraft_entities_killed_by_total',
-            "The count of entities that killed a player",
-            labels=['player', 'entity'])
-
-        mc_custom = CounterMetricFamily(
-            'minecraft_custom', "Custom Minecraft stat",
-            labels=['player', 'custom_stat'])
-
-        # Let's break out some sub-categories from the
-        # custom stats to avoid high label cardinality (where we can)
-        minecraft_distance_traveled_cm = CounterMetricFamily(
-            'minecraft_distance_traveled_cm_total',
-            "The total distance traveled by method of transportation.",
-            labels=['player', 'method'])
-
-        minecraft_interactions_total = CounterMetricFamily(
-            'minecraft_interactions_total',
-            "The number of times interacted with various workstations.",
-            labels=['player', 'workstation'])
-
-        minecraft_damage_total = CounterMetricFamily(
-            'minecraft_damage_total',
-            "The amount of damage a player has dealt/taken by category.",
-            labels=['player', 'category'])
-
-        player_stats_file_path = os.path.join(
-            self.stats_directory, uuid + ".json")
-
-        if not isfile(player_stats_file_path):
+        result = self.parse_cache.get(
+            "stats", self.player_file("stats", uuid),
+            read_player_stats, name, self.metric_filter)
+        if result is None:
             self.logger.error("No statistics for player %s." % uuid)
-            return result
+            return []
 
-        with open(player_stats_file_path) as json_file:
-            data = json.load(json_file)
-            json_file.close()
+        return result
 
-        # I can't think of a reason why I'd ever play an older version
-        # hence removal of pre 1.15 code block.
-        if "stats" not in data:
-            self.logger.error(
-                "No stats key in file %s." % player_stats_file_path)
-        else:
-            stats = data["stats"]
-
-            if "minecraft:mined" in stats:
-                for block, value in stats["minecraft:mined"].items():
-                    blocks_mined.add_metric([name, block], value)
-                result.append(blocks_mined)
-
-            if "minecraft:broken" in stats:
-                for item, value in stats["minecraft:broken"].items():
-                    items_broken.add_metric([name, item], value)
-                result.append(items_broken)
-
-            if "minecraft:crafted" in stats:
-                for item, value in stats["minecraft:crafted"].items():
-                    items_crafted.add_metric([name, item], value)
-                result.append(items_crafted)
-
-            if "minecraft:used" in stats:
-                for item, value in stats["minecraft:used"].items():
-                    items_used.add_metric([name, item], value)
-                result.append(items_used)
-
-            if "minecraft:picked_up" in stats:
-                for item, value in stats["minecraft:picked_up"].items():
-                    items_picked_up.add_metric([name, item], value)
-                result.append(items_picked_up)
-
-            if "minecraft:items_dropped" in stats:
-                for item, value in stats["minecraft:items_dropped"].items():
-                    items_dropped.add_metric([name, item], value)
-                result.append(items_dropped)
-
-            if "minecraft:killed" in stats:
-                for entity, value in stats["minecraft:killed"].items():
-                    entities_killed.add_metric([name, entity], value)
-                result.append(entities_killed)
-
-            if "minecraft:killed_by" in stats:
-                for entity, value in stats["minecraft:killed_by"].items():
-                    entities_killed_by.add_metric([name, entity], value)
-                result.append(entities_killed_by)
-
-            # Grab the custom stats
-            for custom_stat, value in stats["minecraft:custom"].items():
-                if custom_stat.endswith("one_cm"):
-                    minecraft_distance_traveled_cm.add_metric(
-                        [name, custom_stat], value)
-                elif custom_stat.startswith("minecraft:interact"):
-                    minecraft_interactions_total.add_metric(
-                        [name, custom_stat], value
-                    )
-                elif custom_stat.startswith("minecraft:damage"):
-                    minecraft_damage_total.add_metric(
-                        [name, custom_stat], value
-                    )
-                else:
-                    mc_custom.add_metric([name, custom_stat], value)
+    def get_players_samples(self, players):
+        """
+        Does the same as calling get_player_advancements, get_player_data
+        and get_player_stats for every player, but parses the files that
+        are not cached on the worker pool (if one is configured).
+        :param players: A list of (uuid, name) tuples
+        :return: A list of samples in the same order as the sequential calls
+        """
+        return [sample for _, samples in self.get_players_results(players)
+                for sample in samples]
 
-            result.append(minecraft_distance_traveled_cm)
-            result.append(minecraft_interactions_total)
-            result.append(minecraft_damage_total)
-            result.append(mc_custom)
+    def get_players_results(self, players):
+        """
+        Like get_players_samples, but keeps the samples of each file apart.
+        :param players: A list of (uuid, name) tuples
+        :return: A list of ((uuid, source), samples), the samples of a file
+        that didn't change are the same list as on the last call
+        """
+        results = []
+        misses = []
+        for uuid, name in players:
+            for source, reader in (("advancements", read_player_advancements),
+                                   ("playerdata", read_player_data),
+                                   ("stats", read_player_stats)):
+                path = self.player_file(source, uuid)
+                key, samples = self.parse_cache.lookup(
+                    source, path, name, self.metric_filter)
+                if key is None:
+                    self.logger.warning(
+                        "No %s for player %s." % (source, uuid))
+                    samples = []
+                elif samples is None:
+                    misses.append((len(results), path, key, reader, name))
+                results.append(((uuid, source), samples))
+
+        if self.executor is None:
+            parsed = [read_player_file(reader, path, name, self.metric_filter)
+                      for _, path, _, reader, name in misses]
+        else:
+            futures = [self.executor.submit(
+                read_player_file, reader, path, name, self.metric_filter)
+                for _, path, _, reader, name in misses]
+            parsed = [future.result() for future in futures]
+
+        durations = dict((source, 0.0) for source in
+                         ("advancements", "playerdata", "stats"))
+        for (index, path, key, _, _), (samples, duration, error) in \
+                zip(misses, parsed):
+            uuid, source = results[index][0]
+            durations[source] += duration
+            if self.slowest_file is None or duration > self.slowest_file[0]:
+                self.slowest_file = (duration, source, uuid)
+            if error is not None:
+                # Kept in the cache, the file is retried once it changes
+                self.logger.error("Parsing %s failed: %s" % (path, error))
+                self.parse_errors[source] += 1
+            self.parse_cache.store(path, key, samples)
+            results[index] = (results[index][0], samples)
+        for source, duration in durations.items():
+            self.phase_durations.labels(source).observe(duration)
+
+        return results
+
+    def split_players(self, players):
+        """
+        Splits players by whether their stats were saved within the active
+        window (ACTIVE_PLAYER_DAYS).
+        :return: (active players, inactive players)
+        """
+        if self.active_window <= 0:
+            return players, []
+
+        active = []
+        inactive = []
+        since = time.time() - self.active_window
+        for uuid in players:
+            mtime = self.parse_cache.mtime(self.player_file("stats", uuid))
+            if mtime is None or mtime >= since:
+                active.append(uuid)
+            else:
+                inactive.append(uuid)
+        return active, inactive
 
-        return result
+    def get_inactive_samples(self, players):
+        """
+        Re-reads the inactive players every inactive_refresh_interval
+        seconds or when a player joined or left the tier. With
+        INACTIVE_PLAYERS=aggregate they are collapsed into a single player.
+        """
+        if not players:
+            self.inactive_players = set()
+            self.inactive_samples = []
+            return self.inactive_samples
+        if set(players) == self.inactive_players and time.time() < \
+                self.inactive_refreshed_at + self.inactive_refresh_interval:
+            for uuid in players:
+                for source in ("advancements", "playerdata", "stats"):
+                    self.parse_cache.keep(self.player_file(source, uuid))
+            return self.inactive_samples
+
+        if self.inactive_mode == "aggregate" or \
+                self.aggregate_mode == "only":
+            # Names are not needed, don't resolve them
+            samples = collapse_player_samples(self.get_players_samples(
+                [(uuid, uuid) for uuid in players]))
+        else:
+            samples = self.get_players_samples(
+                [(uuid, self.uuid_to_player(uuid)) for uuid in players])
+
+        self.inactive_players = set(players)
+        self.inactive_samples = samples
+        self.inactive_refreshed_at = time.time()
+        return samples
+
+    def get_instrumentation_metrics(self):
+        errors = CounterMetricFamily(
+            'minecraft_exporter_parse_errors',
+            "The number of player files that could not be parsed.",
+            labels=['source'])
+        for source in sorted(self.parse_errors):
+            errors.add_metric([source], self.parse_errors[source])
+        slowest = GaugeMetricFamily(
+            'minecraft_exporter_slowest_player_file_seconds',
+            "Seconds it took to parse the slowest player file this cycle.",
+            labels=['source', 'uuid'])
+        if self.slowest_file is not None:
+            duration, source, uuid = self.slowest_file
+            slowest.add_metric([source, uuid], duration)
+        return self.phase_durations.collect() + [errors, slowest]
 
     def collect(self):
-        for uuid in self.get_players():
-            name = self.uuid_to_player(uuid)  # if this fails we use the UUID
+        for metric in self.collect_players():
+            yield metric
+
+        # Leave this guy alone for now
+        for metric in self.get_server_stats():
+            yield metric
 
-            # TODO fix this so all the yields happen elsewhere
-            metrics = self.get_player_advancements(uuid, name)
-            for metric in metrics:
+    def collect_players(self):
+        """
+        Collects everything that is read from the world directory.
+
+        Scrapes run in parallel, but the aggregators, the parse cache
+        statistics and the inactive players keep state from one cycle to
+        the next, so only one cycle runs at a time.
+        :return: The metric families
+        """
+        with self.collect_lock:
+            return list(self.get_player_metrics())
+
+    def get_player_metrics(self):
+        # Caller holds self.collect_lock
+        self.slowest_file = None
+        start = time.time()
+        self.user_cache.reload()
+        active, inactive = self.split_players(self.get_players())
+        self.phase_durations.labels("get_players").observe(
+            time.time() - start)
+
+        if self.aggregate_mode == "only":
+            # Names are not exported, don't resolve them
+            players = [(uuid, uuid) for uuid in active]
+        else:
+            start = time.time()
+            # if the name lookup fails we use the UUID
+            players = [(uuid, self.uuid_to_player(uuid)) for uuid in active]
+            self.phase_durations.labels("name_resolution").observe(
+                time.time() - start)
+        results = self.get_players_results(players)
+        inactive_samples = self.get_inactive_samples(inactive)
+
+        if self.aggregator is not None:
+            for key, samples in results:
+                self.aggregator.update(key, samples)
+            self.aggregator.update(INACTIVE_PLAYER_LABEL, inactive_samples)
+            self.aggregator.evict_unseen()
+            for metric in build_metric_families(
+                    self.aggregator.get_samples(), SERVER_AGGREGATE_METRICS):
                 yield metric
 
-            metrics = self.get_player_data(uuid, name)
-            for metric in metrics:
+        if self.completions is not None:
+            for key, samples in results:
+                if key[1] == "advancements":
+                    self.completions.update(key, samples)
+            self.completions.update(INACTIVE_PLAYER_LABEL, inactive_samples)
+            self.completions.evict_unseen()
+            ratio = GaugeMetricFamily(
+                'minecraft_advancement_completion_ratio',
+                "The share of players who completed an advancement.",
+                labels=['advancement'])
+            player_count = len(active) + len(inactive)
+            for _, labels, completed in self.completions.get_samples():
+                ratio.add_metric(labels, completed / player_count)
+            yield ratio
+
+        if self.aggregate_mode != "only":
+            samples = [sample for _, samples in results for sample in samples]
+            samples.extend(inactive_samples)
+            for metric in build_metric_families(samples):
                 yield metric
 
-            metrics = self.get_player_stats(uuid, name)
-            for metric in metrics:
+        tiers = GaugeMetricFamily(
+            'minecraft_exporter_players',
+            "The number of players by activity tier.",
+            labels=['tier'])
+        tiers.add_metric(["active"], len(active))
+        tiers.add_metric(["inactive"], len(inactive))
+        yield tiers
+
+        for metric in self.get_instrumentation_metrics():
+            yield metric
+
+        self.parse_cache.evict_unseen()
+        for metric in self.parse_cache.get_metrics():
+            yield metric
+
+        if self.region_collector is not None:
+            for metric in self.region_collector.collect():
+                yield metric
+        if self.nbt_file_collectors:
+            reads = CounterMetricFamily(
+                'minecraft_exporter_nbt_file_reads',
+                "The number of times a changed NBT file was read.",
+                labels=['file'])
+            for collector in self.nbt_file_collectors:
+                for metric in collector.collect():
+                    yield metric
+                reads.add_metric([collector.name], collector.reads)
+            yield reads
+        if not self.shares_name_resolver:
+            for metric in self.name_resolver.get_metrics():
                 yield metric
 
-        # Leave this guy alone for now
+
+def add_server_label(metrics_by_server):
+    """
+    Merges the metric families of several servers into one family per
+    name, adding a server label to every sample.
+    :param metrics_by_server: A list of (server, metric families)
+    """
+    merged = dict()
+    for server, metrics in metrics_by_server:
+        for family in metrics:
+            target = merged.get(family.name)
+            if target is None:
+                target = Metric(family.name, family.documentation,
+                                family.type)
+                merged[family.name] = target
+            target.samples.extend(
+                Sample(sample.name, dict(sample.labels, server=server),
+                       sample.value, sample.timestamp, sample.exemplar)
+                for sample in family.samples)
+    return list(merged.values())
+
+
+class MultiWorldCollector(object):
+    """
+    Collects several worlds (WORLDS_CONFIG) concurrently and exports them
+    with a server label, sharing the name resolver and the worker pool.
+
+    A world that takes longer than the timeout is left out of the scrape
+    and is not collected again until that collection finished, so a hung
+    disk or a huge world never holds up the others.
+    """
+
+    def __init__(self, collectors, name_resolver, timeout):
+        """
+        :param collectors: server label -> MinecraftCollector
+        """
+        self.logger = logging.getLogger(__name__)
+        self.collectors = collectors
+        self.name_resolver = name_resolver
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(
+            max_workers=len(collectors), thread_name_prefix="world")
+        # server -> collection that is still running
+        self.pending = dict()
+        self.up = dict()
+        self.durations = dict()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Reads the JSON list of worlds in WORLDS_CONFIG, each with a server
+        label, a world_dir and optionally a usercache_file, log_file,
+        log_state_file and rcon (host, port, password and timeout).
+        :return: A collector, or None if WORLDS_CONFIG is not set
+        :raises ValueError: If WORLDS_CONFIG lists no worlds
+        """
+        path = os.environ.get("WORLDS_CONFIG")
+        if not path:
+            return None
+        with open(path) as config_file:
+            worlds = json.load(config_file)
+        if not isinstance(worlds, list) or not worlds:
+            raise ValueError(
+                "WORLDS_CONFIG %s has to be a non-empty list of worlds, unset"
+                " it to collect WORLD_DIR." % path)
+
+        name_resolver = NameResolver.from_env()
+        executor = create_executor()
+        collectors = dict()
+        for world in worlds:
+            rcon = None
+            if world.get("rcon"):
+                rcon = RconClient(
+                    world["rcon"]["host"],
+                    int(world["rcon"].get("port", 25575)),
+                    world["rcon"]["password"],
+                    timeout=float(world["rcon"].get("timeout", 5.0)))
+            collectors[world["server"]] = MinecraftCollector(
+                world["world_dir"], rcon, name_resolver,
+                world.get("usercache_file"), executor,
+                world.get("log_file"), world.get("log_state_file"))
+        return cls(collectors, name_resolver,
+                   float(os.environ.get("WORLD_TIMEOUT", 10.0)))
+
+    @staticmethod
+    def collect_world(collector):
+        start = time.time()
+        metrics = list(collector.collect_players())
+        return metrics, time.time() - start
+
+    def collect_players(self):
+        futures = dict()
+        for server, collector in self.collectors.items():
+            if server not in self.pending:
+                self.pending[server] = self.pool.submit(
+                    self.collect_world, collector)
+            futures[server] = self.pending[server]
+        wait(futures.values(), timeout=self.timeout)
+
+        metrics_by_server = []
+        for server, future in futures.items():
+            if not future.done():
+                self.logger.warning(
+                    "Collecting %s takes longer than %.0fs, skipping it."
+                    % (server, self.timeout))
+                self.up[server] = 0
+                continue
+            # A concurrent scrape may have taken the result already
+            self.pending.pop(server, None)
+            # noinspection PyBroadException
+            try:
+                metrics, self.durations[server] = future.result()
+            except Exception:
+                self.logger.exception("Collecting %s failed." % server)
+                self.up[server] = 0
+                continue
+            self.up[server] = 1
+            metrics_by_server.append((server, metrics))
+
+        for metric in add_server_label(metrics_by_server):
+            yield metric
+
+        up = GaugeMetricFamily(
+            'minecraft_exporter_world_up',
+            "Whether the world was collected within WORLD_TIMEOUT.",
+            labels=['server'])
+        duration = GaugeMetricFamily(
+            'minecraft_exporter_world_collect_duration_seconds',
+            "Seconds the last finished collection of a world took.",
+            labels=['server'])
+        for server in self.collectors:
+            up.add_metric([server], self.up.get(server, 0))
+            if server in self.durations:
+                duration.add_metric([server], self.durations[server])
+        yield up
+        yield duration
+
+        for metric in self.name_resolver.get_metrics():
+            yield metric
+
+    def get_server_stats(self):
+        return add_server_label(
+            [(server, collector.get_server_stats())
+             for server, collector in self.collectors.items()])
+
+    def collect(self):
+        for metric in self.collect_players():
+            yield metric
         for metric in self.get_server_stats():
             yield metric
 
 
+class StaticCollector(object):
+    """
+    Yields a fixed list of metric families, e.g. to render a snapshot.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+class SnapshotCollector(object):
+    """
+    Rebuilds the player metrics of a MinecraftCollector in a background
+    thread so that scrapes only have to serve the latest snapshot.
+
+    collect() only yields what is not part of the snapshot (the snapshot
+    gauges and the RCON server stats), the snapshot itself is pre-rendered
+    in the text exposition format and served by ExporterHandler.
+    """
+
+    def __init__(self, collector, interval):
+        self.logger = logging.getLogger(__name__)
+        self.collector = collector
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.exposition = b""
+        self.built_at = None
+        self.build_duration = 0.0
+
+    def start(self):
+        """
+        Builds the first snapshot and starts the background thread.
+        """
+        self.rebuild()
+        thread = threading.Thread(
+            target=self.run, name="snapshot", daemon=True)
+        thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.rebuild()
+
+    def rebuild(self):
+        start = time.time()
+        # noinspection PyBroadException
+        try:
+            metrics = list(self.collector.collect_players())
+            exposition = generate_latest(StaticCollector(metrics))
+        except Exception:
+            self.logger.exception(
+                "Building snapshot failed, keeping the previous one.")
+            return
+
+        with self.lock:
+            self.metrics = metrics
+            self.exposition = exposition
+            self.built_at = time.time()
+            self.build_duration = self.built_at - start
+        self.logger.debug(
+            "Built snapshot in %.3fs." % self.build_duration)
+
+    def collect(self):
+        age = GaugeMetricFamily(
+            'minecraft_exporter_snapshot_age_seconds',
+            "Seconds since the served snapshot was built.")
+        duration = GaugeMetricFamily(
+            'minecraft_exporter_snapshot_build_duration_seconds',
+            "Seconds it took to build the served snapshot.")
+
+        with self.lock:
+            if self.built_at is not None:
+                age.add_metric([], time.time() - self.built_at)
+                duration.add_metric([], self.build_duration)
+
+        yield age
+        yield duration
+
+        for metric in self.collector.get_server_stats():
+            yield metric
+
+    def render(self, registry=REGISTRY):
+        """
+        :return: The pre-rendered snapshot followed by the live metrics
+        """
+        with self.lock:
+            exposition = self.exposition
+        return exposition + generate_latest(registry)
+
+
+def profile_collection(collector):
+    """
+    Runs one collection cycle under cProfile. Like a scrape it waits for
+    a cycle that is already running, the wait is not profiled. Work done
+    on other threads or processes (COLLECT_WORKERS, WORLDS_CONFIG) is only
+    seen as waiting.
+    :return: The stats in the format of cProfile's dump_stats, for pstats
+    """
+    if isinstance(collector, MinecraftCollector):
+        # The lock of collect_players, taken before profiling starts
+        lock, collect = collector.collect_lock, collector.get_player_metrics
+    else:
+        # Every world takes its own lock
+        lock, collect = contextlib.nullcontext(), collector.collect_players
+
+    profile = cProfile.Profile()
+    with lock:
+        profile.enable()
+        try:
+            list(collect())
+            collector.get_server_stats()
+        finally:
+            profile.disable()
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
+
+
+class ExporterHandler(MetricsHandler):
+    """
+    Serves the metrics of REGISTRY, or the pre-rendered snapshot in
+    snapshot mode, and with PROFILE_ENDPOINT=true a profile of one
+    collection cycle on /profile.
+    """
+    snapshot = None
+    collector = None
+    profile = False
+
+    def do_GET(self):
+        if self.profile and urlparse(self.path).path == "/profile":
+            self.send_output("application/octet-stream",
+                             profile_collection(self.collector))
+        elif self.snapshot is not None:
+            self.send_output(CONTENT_TYPE_LATEST, self.snapshot.render())
+        else:
+            MetricsHandler.do_GET(self)
+
+    def send_output(self, content_type, output):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+
+def filter_players(metrics, players):
+    """
+    :param players: The values of the player label to keep
+    :return: The families with only the samples of those players
+    """
+    result = []
+    for family in metrics:
+        samples = [sample for sample in family.samples
+                   if sample.labels.get("player") in players]
+        if samples:
+            filtered = Metric(family.name, family.documentation, family.type)
+            filtered.samples = samples
+            result.append(filtered)
+    return result
+
+
+def render_metrics(metrics, openmetrics, players, compress):
+    """
+    :return: The exposition of the metric families
+    """
+    if players:
+        metrics = filter_players(metrics, players)
+    if openmetrics:
+        output = generate_openmetrics(StaticCollector(metrics))
+    else:
+        output = generate_latest(StaticCollector(metrics))
+    if compress:
+        output = gzip.compress(output, compresslevel=6)
+    return output
+
+
+class AsyncExporter(object):
+    """
+    Serves the metrics with asyncio (HTTP_SERVER=asyncio), collecting and
+    rendering on the default executor so the event loop stays free.
+
+    Scrapes that arrive while a collection is running wait for it instead
+    of starting their own, and each rendering of a collection (format,
+    ?player= filter, gzip) is only done once for all of them. Supports
+    OpenMetrics, gzip and /healthz.
+    """
+
+    def __init__(self, registry=REGISTRY, snapshot=None, collector=None,
+                 profile=False):
+        self.logger = logging.getLogger(__name__)
+        self.registry = registry
+        self.snapshot = snapshot
+        self.collector = collector
+        self.profile = profile
+        # the collection that is running
+        self.pending = None
+
+    def collect_metrics(self):
+        metrics = []
+        if self.snapshot is not None:
+            with self.snapshot.lock:
+                metrics.extend(self.snapshot.metrics)
+        metrics.extend(self.registry.collect())
+        return metrics
+
+    async def run_collection(self):
+        loop = asyncio.get_running_loop()
+        try:
+            metrics = await loop.run_in_executor(None, self.collect_metrics)
+            # (openmetrics, players, compress) -> future of the rendering
+            return metrics, dict()
+        finally:
+            self.pending = None
+
+    async def get_output(self, key):
+        """
+        :return: The output of a collection, joining a running one
+        """
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.run_collection())
+        # a scraper that goes away must not cancel it for the others
+        metrics, renderings = await asyncio.shield(self.pending)
+
+        rendering = renderings.get(key)
+        if rendering is None:
+            rendering = asyncio.get_running_loop().run_in_executor(
+                None, render_metrics, metrics, *key)
+            renderings[key] = rendering
+        return await asyncio.shield(rendering)
+
+    async def respond(self, method, target, headers):
+        """
+        :return: (status, headers, body)
+        """
+        url = urlparse(target)
+        if url.path == "/healthz":
+            return 200, {"Content-Type": "text/plain"}, b"OK\n"
+        if method not in ("GET", "HEAD"):
+            return 405, {"Content-Type": "text/plain"}, b"Method not allowed\n"
+        if self.profile and url.path == "/profile":
+            output = await asyncio.get_running_loop().run_in_executor(
+                None, profile_collection, self.collector)
+            return 200, {"Content-Type": "application/octet-stream"}, output
+        if url.path not in ("/", "/metrics"):
+            return 404, {"Content-Type": "text/plain"}, b"Not found\n"
+
+        openmetrics = "application/openmetrics-text" in \
+            headers.get("accept", "")
+        compress = "gzip" in headers.get("accept-encoding", "")
+        players = frozenset(parse_qs(url.query).get("player", []))
+        output = await self.get_output((openmetrics, players, compress))
+
+        response_headers = {
+            "Content-Type": OPENMETRICS_CONTENT_TYPE if openmetrics
+            else CONTENT_TYPE_LATEST,
+            "Vary": "Accept, Accept-Encoding",
+        }
+        if compress:
+            response_headers["Content-Encoding"] = "gzip"
+        return 200, response_headers, output
+
+    async def handle(self, reader, writer):
+        # noinspection PyBroadException
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, version = lines[0].split(" ", 2)
+                headers = dict()
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+
+                status, response_headers, body = await self.respond(
+                    method, target, headers)
+                keep_alive = version == "HTTP/1.1" and \
+                    headers.get("connection", "").lower() != "close"
+                response_headers["Content-Length"] = str(len(body))
+                if not keep_alive:
+                    response_headers["Connection"] = "close"
+                writer.write(("HTTP/1.1 %i %s\r\n%s\r\n" % (
+                    status, HTTP_REASONS.get(status, ""),
+                    "".join("%s: %s\r\n" % header
+                            for header in response_headers.items()))
+                              ).encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        except Exception:
+            self.logger.exception("Serving a request failed.")
+        finally:
+            writer.close()
+
+    async def serve(self, port):
+        server = await asyncio.start_server(self.handle, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+HTTP_REASONS = {
+    200: "OK",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
 if __name__ == '__main__':
     logger = logging.getLogger(__name__)
 
@@ -542,9 +3687,36 @@ if __name__ == '__main__':
     if all(x in os.environ for x in ['RCON_HOST', 'RCON_PASSWORD']):
         logger.info("RCON is enabled for " + os.environ['RCON_HOST'])
 
-    start_http_server(8000)
-    REGISTRY.register(MinecraftCollector())
+    collector = MultiWorldCollector.from_env()
+    if collector is None:
+        collector = MinecraftCollector.from_env()
+    else:
+        logger.info("Collecting %i worlds." % len(collector.collectors))
+
+    snapshot_interval = int(os.environ.get("SNAPSHOT_INTERVAL", "0"))
+    if snapshot_interval > 0:
+        logger.info("Serving snapshots rebuilt every %is." % snapshot_interval)
+        snapshot_collector = SnapshotCollector(collector, snapshot_interval)
+        snapshot_collector.start()
+        REGISTRY.register(snapshot_collector)
+        ExporterHandler.snapshot = snapshot_collector
+    else:
+        REGISTRY.register(collector)
+
+    profile = os.environ.get("PROFILE_ENDPOINT", "false") == "true"
+    if profile:
+        logger.info("Serving profiles of a collection cycle on /profile.")
+    if os.environ.get("HTTP_SERVER", "thread") == "asyncio":
+        logger.info("Exporter started on Port 8000")
+        asyncio.run(AsyncExporter(
+            snapshot=ExporterHandler.snapshot, collector=collector,
+            profile=profile).serve(8000))
+
+    ExporterHandler.collector = collector
+    ExporterHandler.profile = profile
+    server = ThreadingHTTPServer(('', 8000), ExporterHandler)
+    threading.Thread(
+        target=server.serve_forever, name="http", daemon=True).start()
     logger.info("Exporter started on Port 8000")
     while True:
         time.sleep(1)
-        schedule.run_pending()
@@ -0,0 +1,119 @@
+import gzip
+import random
+import struct
+
+import minecraft_exporter as me
+from benchmark import generate_chunk, generate_player_data, nbt_compound, \
+    nbt_list, nbt_string, nbt_tag
+
+
+def int_array(values):
+    return struct.pack(">i%ii" % len(values), len(values), *values)
+
+
+# Tags of every type that are not asked for, in front of the wanted ones
+UNKNOWN_TAGS = [
+    nbt_tag(1, "byte", struct.pack(">b", 1)),
+    nbt_tag(2, "short", struct.pack(">h", 2)),
+    nbt_tag(4, "long", struct.pack(">q", 4)),
+    nbt_tag(5, "float", struct.pack(">f", 5)),
+    nbt_tag(6, "double", struct.pack(">d", 6)),
+    nbt_tag(7, "byte_array", struct.pack(">i", 3) + b"abc"),
+    nbt_tag(8, "string", nbt_string("Größe")),
+    nbt_tag(9, "empty_list", nbt_list(0, [])),
+    nbt_tag(9, "ints", nbt_list(3, [struct.pack(">i", i) for i in range(4)])),
+    nbt_tag(9, "Inventory", nbt_list(10, [
+        nbt_compound([nbt_tag(8, "id", nbt_string("minecraft:stone")),
+                      nbt_tag(9, "Lore", nbt_list(8, [nbt_string("x")]))])
+        for _ in range(3)])),
+    nbt_tag(10, "compound", nbt_compound([
+        nbt_tag(10, "nested", nbt_compound([
+            nbt_tag(3, "XpLevel", struct.pack(">i", -1))]))])),
+    nbt_tag(11, "int_array", int_array([1, 2, 3])),
+    nbt_tag(12, "long_array", struct.pack(">iqq", 2, 1, 2)),
+]
+
+
+def test_selected_tags_are_decoded():
+    data = nbt_tag(10, "", nbt_compound(UNKNOWN_TAGS + [
+        nbt_tag(3, "XpLevel", struct.pack(">i", 30)),
+        nbt_tag(5, "Health", struct.pack(">f", 19.5)),
+        nbt_tag(8, "Dimension", nbt_string("minecraft:the_nether")),
+        nbt_tag(11, "UUID", int_array([1, -2, 3, -4])),
+    ] + UNKNOWN_TAGS))
+    assert me.read_nbt_tags(data, {
+        "XpLevel": True, "Health": True, "Dimension": True, "UUID": True,
+        "Missing": True,
+    }) == {
+        "XpLevel": 30,
+        "Health": 19.5,
+        "Dimension": "minecraft:the_nether",
+        "UUID": [1, -2, 3, -4],
+    }
+
+
+def test_unknown_tags_are_skipped():
+    data = nbt_tag(10, "", nbt_compound(UNKNOWN_TAGS + [
+        nbt_tag(3, "Score", struct.pack(">i", 7))]))
+    # Everything in front of Score was skipped by its length
+    assert me.read_nbt_tags(data, {"Score": True}) == {"Score": 7}
+    # Nested compounds are only entered when asked for
+    assert me.read_nbt_tags(
+        data, {"compound": {"nested": {"XpLevel": True}}}) == \
+        {"compound": {"nested": {"XpLevel": -1}}}
+
+
+def test_walk_stops_when_all_tags_were_found():
+    data = nbt_tag(10, "", nbt_compound([
+        nbt_tag(3, "Score", struct.pack(">i", 7))]))
+    # Cut off after Score, without the end of the compound
+    assert me.read_nbt_tags(data[:-1] + b"\xff", {"Score": True}) == \
+        {"Score": 7}
+
+
+def test_lengths():
+    data = nbt_tag(10, "", nbt_compound(UNKNOWN_TAGS))
+    assert me.read_nbt_tags(data, {
+        "byte_array": me.NBT_LENGTH,
+        "string": me.NBT_LENGTH,
+        "empty_list": me.NBT_LENGTH,
+        "ints": me.NBT_LENGTH,
+        "Inventory": me.NBT_LENGTH,
+        "compound": me.NBT_LENGTH,
+        "int_array": me.NBT_LENGTH,
+        "long_array": me.NBT_LENGTH,
+    }) == {
+        "byte_array": 3,
+        # bytes of the UTF-8 encoded string
+        "string": 7,
+        "empty_list": 0,
+        "ints": 4,
+        "Inventory": 3,
+        "compound": 1,
+        "int_array": 3,
+        "long_array": 2,
+    }
+
+
+def test_player_data(tmp_path):
+    rng = random.Random(1)
+    data = generate_player_data(rng)
+    path = tmp_path / "player.dat"
+    path.write_bytes(data)
+
+    full = me.decode_nbt_payload(gzip.decompress(data), 10, 3)[0]
+    tags = me.read_nbt_file(str(path), me.PLAYER_DATA_WANTED)
+    assert tags == dict((tag, full[tag]) for tag in me.PLAYER_DATA_TAGS)
+
+    samples = me.read_player_data(str(path), "alice")
+    assert ('minecraft_xp_total', ("alice",), full["XpTotal"]) in samples
+    assert ('minecraft_dimension', ("alice", full["Dimension"]),
+            me.get_dimension_value(full["Dimension"])) in samples
+
+
+def test_chunk_entities():
+    rng = random.Random(1)
+    assert me.count_chunk_entities(generate_chunk(rng, 0, 4)) == (0, 4)
+    assert me.count_chunk_entities(generate_chunk(rng, 0, 0)) == (0, 0)
+    assert me.count_chunk_entities(
+        generate_chunk(rng, 5, 3, legacy=True)) == (5, 3)
@@ -0,0 +1,301 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import minecraft_exporter as me
+from benchmark import start_fake_rcon
+
+
+# Outputs captured from the servers, including their formatting codes
+
+VANILLA_LIST = "There are 2 of a max of 20 players online: alice, bob"
+VANILLA_LIST_EMPTY = "There are 0 of a max of 20 players online: "
+VANILLA_LIST_1_12 = "There are 2/20 players online:\nalice, bob"
+PAPER_LIST = (
+    "§6There are §c3§6 out of maximum §c50§6 players online.\n"
+    "§6default§r: §falice§r, §fbob\n"
+    "§6admin§r: §fcarol")
+
+FORGE_TPS_1_16 = (
+    "Dim minecraft:overworld (minecraft:overworld): Mean tick time: 0.560"
+    " ms. Mean TPS: 20.000\n"
+    "Dim minecraft:the_nether (minecraft:the_nether): Mean tick time: 0.123"
+    " ms. Mean TPS: 20.000\n"
+    "Overall: Mean tick time: 1.234 ms. Mean TPS: 20.000")
+FORGE_TPS_1_12 = (
+    "Dim   0 (overworld) : Mean tick time: 3.2 ms. Mean TPS: 20.000\n"
+    "Dim  -1 (the_nether) : Mean tick time: 0.1 ms. Mean TPS: 19.500\n"
+    "Overall : Mean tick time: 3.5 ms. Mean TPS: 20.000")
+
+PAPER_TPS = "§6TPS from last 1m, 5m, 15m: §a*20.0, §a19.98, §a20.0"
+PAPER_MSPT = (
+    "§6Server tick times §e(§7avg§e/§7min§e/§7max§e)§6 from last"
+    " 5s§7,§6 10s§7,§6 1m§e:\n"
+    "§6◴ §a1.2§7/§a0.5§7/§a3.4§7, §a1.1§7/§a0.4§7/§a3.0§7,"
+    " §a1.3§7/§a0.4§7/§a5.0")
+
+TICK_QUERY = (
+    "The game is running normallyTarget tick rate: 20.0 per second.\n"
+    "Average time per tick: 0.8ms (Target: 50.0ms)"
+    "Percentiles: P50: 0.7ms P95: 1.2ms P99: 1.6ms, sample: 100")
+
+ENTITIES_PASSED = "Test passed, count: 42"
+ENTITIES_FAILED = "Test failed"
+
+PAPER_CHUNKINFO = (
+    "§3Chunks in §9world§3:\n"
+    "§3Total: §9529§3 Inactive: §90§3 Border: §90§3 Ticking: §9441§3"
+    " Entity: §9441\n"
+    "§3Chunks in §9world_nether§3:\n"
+    "§3Total: §912§3 Inactive: §90§3 Border: §90§3 Ticking: §90§3"
+    " Entity: §90\n"
+    "§3Chunks in §9all listed worlds§3:\n"
+    "§3Total: §9541")
+
+
+def parse(parser, output, command=None):
+    return parser.parse(command or parser.commands[0], output)
+
+
+def test_list_vanilla():
+    assert parse(me.ListParser(), VANILLA_LIST) == [
+        ('minecraft_players_online', (), 2),
+        ('minecraft_players_max', (), 20),
+        ('minecraft_player_online', ('alice',), 1),
+        ('minecraft_player_online', ('bob',), 1),
+    ]
+
+
+def test_list_vanilla_empty():
+    assert parse(me.ListParser(), VANILLA_LIST_EMPTY) == [
+        ('minecraft_players_online', (), 0),
+        ('minecraft_players_max', (), 20),
+    ]
+
+
+def test_list_vanilla_1_12():
+    assert parse(me.ListParser(), VANILLA_LIST_1_12) == [
+        ('minecraft_players_online', (), 2),
+        ('minecraft_players_max', (), 20),
+        ('minecraft_player_online', ('alice',), 1),
+        ('minecraft_player_online', ('bob',), 1),
+    ]
+
+
+def test_list_paper_groups():
+    assert parse(me.ListParser(), PAPER_LIST) == [
+        ('minecraft_players_online', (), 3),
+        ('minecraft_players_max', (), 50),
+        ('minecraft_player_online', ('alice',), 1),
+        ('minecraft_player_online', ('bob',), 1),
+        ('minecraft_player_online', ('carol',), 1),
+    ]
+
+
+def test_forge_tps_1_16():
+    assert parse(me.ForgeTpsParser(), FORGE_TPS_1_16) == [
+        ('minecraft_mspt_milliseconds',
+         ('minecraft:overworld', '100t', 'mean'), 0.56),
+        ('minecraft_tps', ('minecraft:overworld', '100t'), 20.0),
+        ('minecraft_mspt_milliseconds',
+         ('minecraft:the_nether', '100t', 'mean'), 0.123),
+        ('minecraft_tps', ('minecraft:the_nether', '100t'), 20.0),
+        ('minecraft_mspt_milliseconds', ('overall', '100t', 'mean'), 1.234),
+        ('minecraft_tps', ('overall', '100t'), 20.0),
+    ]
+
+
+def test_forge_tps_1_12():
+    assert parse(me.ForgeTpsParser(), FORGE_TPS_1_12) == [
+        ('minecraft_mspt_milliseconds', ('overworld', '100t', 'mean'), 3.2),
+        ('minecraft_tps', ('overworld', '100t'), 20.0),
+        ('minecraft_mspt_milliseconds', ('the_nether', '100t', 'mean'), 0.1),
+        ('minecraft_tps', ('the_nether', '100t'), 19.5),
+        ('minecraft_mspt_milliseconds', ('overall', '100t', 'mean'), 3.5),
+        ('minecraft_tps', ('overall', '100t'), 20.0),
+    ]
+
+
+def test_paper_tps():
+    assert parse(me.PaperTpsParser(), PAPER_TPS) == [
+        ('minecraft_tps', ('overall', '1m'), 20.0),
+        ('minecraft_tps', ('overall', '5m'), 19.98),
+        ('minecraft_tps', ('overall', '15m'), 20.0),
+    ]
+
+
+def test_paper_mspt():
+    assert parse(me.PaperMsptParser(), PAPER_MSPT) == [
+        ('minecraft_mspt_milliseconds', ('overall', '5s', 'mean'), 1.2),
+        ('minecraft_mspt_milliseconds', ('overall', '5s', 'min'), 0.5),
+        ('minecraft_mspt_milliseconds', ('overall', '5s', 'max'), 3.4),
+        ('minecraft_mspt_milliseconds', ('overall', '10s', 'mean'), 1.1),
+        ('minecraft_mspt_milliseconds', ('overall', '10s', 'min'), 0.4),
+        ('minecraft_mspt_milliseconds', ('overall', '10s', 'max'), 3.0),
+        ('minecraft_mspt_milliseconds', ('overall', '1m', 'mean'), 1.3),
+        ('minecraft_mspt_milliseconds', ('overall', '1m', 'min'), 0.4),
+        ('minecraft_mspt_milliseconds', ('overall', '1m', 'max'), 5.0),
+    ]
+
+
+def test_tick_query():
+    assert parse(me.TickQueryParser(), TICK_QUERY) == [
+        ('minecraft_tick_rate_target', (), 20.0),
+        ('minecraft_mspt_milliseconds', ('overall', 'sample', 'mean'), 0.8),
+        ('minecraft_mspt_milliseconds', ('overall', 'sample', 'p50'), 0.7),
+        ('minecraft_mspt_milliseconds', ('overall', 'sample', 'p95'), 1.2),
+        ('minecraft_mspt_milliseconds', ('overall', 'sample', 'p99'), 1.6),
+    ]
+
+
+def test_entity_count(monkeypatch):
+    monkeypatch.setenv("RCON_DIMENSIONS", "minecraft:overworld,custom:mine")
+    parser = me.EntityCountParser()
+    overworld, mine = parser.commands
+    assert overworld == "execute in minecraft:overworld positioned 0 0 0" \
+                       " if entity @e[distance=0..]"
+    assert parse(parser, ENTITIES_PASSED, mine) == [
+        ('minecraft_entities_loaded', ('custom:mine',), 42)]
+    assert parse(parser, ENTITIES_FAILED, overworld) == [
+        ('minecraft_entities_loaded', ('minecraft:overworld',), 0)]
+    assert parse(parser, "Unknown dimension", overworld) == []
+
+
+def test_paper_chunkinfo():
+    assert parse(me.PaperChunkInfoParser(), PAPER_CHUNKINFO) == [
+        ('minecraft_chunks_loaded', ('world',), 529),
+        ('minecraft_chunks_ticking', ('world',), 441),
+        ('minecraft_chunks_loaded', ('world_nether',), 12),
+        ('minecraft_chunks_ticking', ('world_nether',), 0),
+    ]
+
+
+@pytest.mark.parametrize("parser", sorted(me.RCON_PARSERS))
+def test_unrelated_output(parser):
+    parser = me.RCON_PARSERS[parser]()
+    assert parse(parser, "Unknown or incomplete command") == []
+
+
+class FakeRcon(object):
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def command(self, command):
+        output = self.outputs[command]
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+
+class BrokenParser(me.RconParser):
+    commands = ("broken",)
+
+    def parse(self, command, output):
+        raise ValueError("Unexpected output")
+
+
+def test_poller_drops_samples_of_failed_commands():
+    rcon = FakeRcon({"list": VANILLA_LIST, "broken": "?"})
+    poller = me.RconPoller(rcon, [me.ListParser(), BrokenParser()])
+    poller.poll()
+    assert len(poller.get_samples()) == 4
+
+    # The server stopped, or the reply can't be parsed
+    rcon.outputs["list"] = me.RconError("RCON is not connected.")
+    poller.poll()
+    assert poller.get_samples() == []
+
+    rcon.outputs["list"] = VANILLA_LIST
+    poller.poll()
+    assert len(poller.get_samples()) == 4
+    rcon.outputs["list"] = struct.error("unpack requires a buffer")
+    poller.poll()
+    assert poller.get_samples() == []
+
+
+def connect(port, password="secret"):
+    client = me.RconClient("127.0.0.1", port, password, timeout=2.0)
+    client.reconnect()
+    return client
+
+
+def test_client_reassembles_long_responses():
+    # More than 4096 bytes, sent back in several packets
+    long_output = "x" * 5000 + "y" * 5000
+    port = start_fake_rcon("secret", [], {"long": long_output})
+    client = connect(port)
+    assert client.state == me.RconClient.CIRCUIT_CLOSED
+    assert client.command("long") == long_output
+    assert client.command("list") == \
+        "There are 0 of a max of 100 players online: "
+    client.disconnect()
+
+
+def test_client_login_failure_opens_circuit():
+    port = start_fake_rcon("secret", [])
+    client = connect(port, password="wrong")
+    assert client.state == me.RconClient.CIRCUIT_OPEN
+    assert client.connects == {"failed": 1}
+    with pytest.raises(me.RconError):
+        client.command("list")
+    assert client.commands == {"rejected": 1}
+
+
+def test_client_open_circuit_fails_fast():
+    # A port nobody listens on
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+
+    client = connect(port)
+    assert client.state == me.RconClient.CIRCUIT_OPEN
+    assert client.retry_at > time.time()
+    start = time.time()
+    with pytest.raises(me.RconError):
+        client.command("list")
+    assert time.time() - start < 0.1
+    assert client.commands == {"rejected": 1}
+
+
+def test_client_lost_connection_opens_circuit():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    client = me.RconClient(
+        "127.0.0.1", server.getsockname()[1], "secret", timeout=2.0)
+    # Connect by hand, the server goes away without answering
+    client.socket = socket.create_connection(server.getsockname())
+    client.state = me.RconClient.CIRCUIT_CLOSED
+    connection, _ = server.accept()
+    connection.close()
+    server.close()
+
+    with pytest.raises(me.RconError):
+        client.command("list")
+    assert client.state == me.RconClient.CIRCUIT_OPEN
+    assert client.socket is None
+    assert client.commands == {"failed": 1}
+
+
+def test_client_rejects_garbled_reply():
+    # Something else listening on the RCON port, answering the login with
+    # a packet too short for RCON
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def answer():
+        connection, _ = server.accept()
+        connection.recv(1024)
+        connection.sendall(struct.pack("<i", 4) + b"abcd")
+        connection.close()
+
+    threading.Thread(target=answer, daemon=True).start()
+    client = connect(server.getsockname()[1])
+    server.close()
+    assert client.state == me.RconClient.CIRCUIT_OPEN
+    assert client.connects == {"failed": 1}
@@ -0,0 +1,62 @@
+import random
+import threading
+
+import minecraft_exporter as me
+from benchmark import generate_world, touch_players
+
+
+def mined_totals(metrics):
+    """
+    :return: (sum of the player series, sum of the server series) of
+    minecraft_blocks_mined
+    """
+    players = server = 0
+    for family in metrics:
+        for sample in family.samples:
+            if sample.name == 'minecraft_blocks_mined_total':
+                players += sample.value
+            elif sample.name == 'minecraft_server_blocks_mined_total':
+                server += sample.value
+    return players, server
+
+
+def test_concurrent_scrapes_keep_totals_consistent(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGGREGATE_METRICS", "on")
+    players = generate_world(str(tmp_path), 60, seed=1, usercache_share=1.0)
+    collector = me.MinecraftCollector(str(tmp_path / "world"))
+
+    results = []
+    errors = []
+    stop = threading.Event()
+
+    def scrape():
+        try:
+            for _ in range(6):
+                results.append(mined_totals(collector.collect_players()))
+        except Exception as e:
+            errors.append(e)
+
+    def save():
+        # Like the server saving the stats of some players
+        rng = random.Random(2)
+        while not stop.is_set():
+            touch_players(str(tmp_path), players, 0.2, rng)
+
+    saver = threading.Thread(target=save)
+    saver.start()
+    scrapers = [threading.Thread(target=scrape) for _ in range(6)]
+    for thread in scrapers:
+        thread.start()
+    for thread in scrapers:
+        thread.join()
+    stop.set()
+    saver.join()
+
+    assert errors == []
+    assert len(results) == 36
+    for players_sum, server_sum in results:
+        assert players_sum == server_sum
+
+    players_sum, server_sum = mined_totals(collector.collect_players())
+    assert players_sum > 0
+    assert players_sum == server_sum